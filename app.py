@@ -5,23 +5,45 @@ import unicodedata
 import io
 import fitz  # PyMuPDF
 import pandas as pd
-from collections import OrderedDict
-from flask import Flask, request, send_file, url_for, make_response, jsonify, session, redirect
+from collections import Counter, OrderedDict, deque
+from functools import wraps
+from contextlib import contextmanager
+from flask import Flask, request, send_file, url_for, make_response, jsonify, session, redirect, Response, stream_with_context
 import json
-import traceback
+import html
+import gzip
+import hashlib
+import heapq
+import sys
+import logging
+import logging.handlers
+import queue
+import atexit
+import contextvars
 import openpyxl
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import NamedStyle, Font, Alignment, PatternFill, Border, Side
 from openpyxl.utils import get_column_letter
 from copy import copy
 import zipfile
+import mmap
 import time # Importado para logs
+import threading
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import base64
 import requests
 from datetime import datetime
 
 # ==== Constantes e Mapeamentos ====
 DASHES = dict.fromkeys(map(ord, "\u2010\u2011\u2012\u2013\u2014\u2015\u2212"), "-")
+TABELA_NORMALIZACAO = {
+    **DASHES,
+    0x00A0: " ", # nbsp
+    **dict.fromkeys(map(ord, "\u200B\u200C\u200D\uFEFF")), # ZWSP e similares são removidos
+}
 HEADERS = (
     "Remessa para Conferência", "Página", "Banco", "IMOBILIARIOS", "Débitos do Mês",
     "Vencimento", "Lançamentos", "Programação", "Carta", "DÉBITOS", "ENCARGOS",
@@ -69,6 +91,51 @@ BASE_FIXOS_CCB = {
     "Negociação Alienação CCB": []
 }
 
+# ==== Logging estruturado ====
+# Os registros vão para uma fila e uma thread separada escreve no stdout, para que as threads
+# das requisições não esperem pelo I/O (PYTHONUNBUFFERED=1 torna cada escrita síncrona).
+#   LOG_LEVEL -> nível mínimo (padrão: INFO; DEBUG mostra os avisos por valor/planilha)
+#   LOG_JSON  -> "1" para uma linha JSON por registro
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_JSON  = os.environ.get('LOG_JSON') == '1'
+# Identificador da requisição (ou do job) presente em todas as linhas de log
+ID_CORRELACAO = contextvars.ContextVar('id_correlacao', default='-')
+
+class _FiltroCorrelacao(logging.Filter):
+    def filter(self, record):
+        record.id_correlacao = ID_CORRELACAO.get()
+        return True
+
+class _FormatadorJson(logging.Formatter):
+    def format(self, record):
+        registro = {
+            'ts': self.formatTime(record), 'nivel': record.levelname, 'id': record.id_correlacao,
+            'pid': record.process, 'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            registro['exc'] = self.formatException(record.exc_info)
+        return json.dumps(registro, ensure_ascii=False)
+
+def configurar_logging():
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(_FormatadorJson() if LOG_JSON else
+                       logging.Formatter('%(asctime)s %(levelname)s [%(process)d %(id_correlacao)s] %(message)s'))
+    fila = queue.SimpleQueue()
+    handler_fila = logging.handlers.QueueHandler(fila)
+    # O filtro roda no handler da fila, ainda na thread que gerou o registro
+    handler_fila.addFilter(_FiltroCorrelacao())
+    ouvinte = logging.handlers.QueueListener(fila, saida)
+    ouvinte.start()
+    atexit.register(ouvinte.stop) # Esvazia a fila ao encerrar
+
+    logger = logging.getLogger('conferencia')
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(handler_fila)
+    logger.propagate = False
+    return logger
+
+log = configurar_logging()
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'kasil-validador-chave-interna')
 CONFIG_SENHA   = os.environ.get('CONFIG_SENHA', 'kasil2025')
@@ -124,11 +191,11 @@ def commitar_config_github(config: dict, alteracoes: list = None):
             payload['sha'] = sha
         r_put = requests.put(api_url, headers=headers, json=payload, timeout=15)
         if r_put.status_code in (200, 201):
-            print(f"[GITHUB] config.json comitado em {GITHUB_REPO}@{GITHUB_BRANCH}.")
+            log.info(f"[GITHUB] config.json comitado em {GITHUB_REPO}@{GITHUB_BRANCH}.")
             return True, 'Configuração versionada no GitHub.'
         return False, f'Falha ao comitar ({r_put.status_code}): {r_put.text[:200]}'
     except Exception as e:
-        print(f"[GITHUB] ERRO ao comitar config: {e}")
+        log.error(f"[GITHUB] ERRO ao comitar config: {e}")
         return False, str(e)
 
 # Define UPLOAD_FOLDER como um caminho absoluto relativo à raiz do app
@@ -136,10 +203,10 @@ UPLOAD_FOLDER_PATH = os.path.join(app.root_path, 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER_PATH
 # Cria o diretório usando o caminho absoluto
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-print(f"Pasta de Upload configurada em: {app.config['UPLOAD_FOLDER']}")
+log.info(f"Pasta de Upload configurada em: {app.config['UPLOAD_FOLDER']}")
 
 CONFIG_PATH = os.path.join(app.root_path, 'config.json')
-print(f"[CONFIG] Caminho do config.json: {CONFIG_PATH}")
+log.info(f"[CONFIG] Caminho do config.json: {CONFIG_PATH}")
 
 CONFIG_PADRAO = {
     "EMP_MAP": {
@@ -171,10 +238,10 @@ def carregar_config() -> dict:
             cfg = json.load(f)
             return cfg
     except FileNotFoundError:
-        print(f"[CONFIG] config.json não encontrado em '{CONFIG_PATH}'. Usando padrão.")
+        log.warning(f"[CONFIG] config.json não encontrado em '{CONFIG_PATH}'. Usando padrão.")
         return {k: dict(v) for k, v in CONFIG_PADRAO.items()}
     except json.JSONDecodeError as e:
-        print(f"[CONFIG] ERRO ao ler config.json (JSON inválido): {e}. Usando padrão.")
+        log.error(f"[CONFIG] ERRO ao ler config.json (JSON inválido): {e}. Usando padrão.")
         return {k: dict(v) for k, v in CONFIG_PADRAO.items()}
 
 HISTORY_PATH = os.path.join(app.root_path, 'config_historico.json')
@@ -217,14 +284,26 @@ def salvar_config(config: dict):
     with open(tmp_cfg, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
     os.replace(tmp_cfg, CONFIG_PATH)
-    print(f"[CONFIG] config.json salvo em '{CONFIG_PATH}'. {len(alteracoes)} alteração(ões) detectada(s).")
+    log.info(f"[CONFIG] config.json salvo em '{CONFIG_PATH}'. {len(alteracoes)} alteração(ões) detectada(s).")
     return alteracoes
 
+_CACHE_TEMPLATES = {} # caminho -> (mtime, conteúdo)
+
+def _ler_template(template_path: str) -> str:
+    """Lê o template do disco só quando ele muda (o stat é bem mais barato que reler o arquivo)."""
+    mtime = os.path.getmtime(template_path)
+    cache = _CACHE_TEMPLATES.get(template_path)
+    if cache and cache[0] == mtime:
+        return cache[1]
+    with open(template_path, 'r', encoding='utf-8') as f:
+        conteudo = f.read()
+    _CACHE_TEMPLATES[template_path] = (mtime, conteudo)
+    return conteudo
+
 def manual_render_template(template_name, status_code=200, **kwargs):
     template_path = os.path.join(app.root_path, 'templates', template_name)
     try:
-        with open(template_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
+        html_content = _ler_template(template_path)
 
         for key, value in kwargs.items():
             placeholder = f"__{key.upper()}__"
@@ -240,7 +319,7 @@ def manual_render_template(template_name, status_code=200, **kwargs):
         response.headers['Content-Type'] = 'text/html'
         return response, status_code
     except Exception as e:
-        print(f"ERRO CRÍTICO AO RENDERIZAR MANUALMENTE '{template_name}': {e}")
+        log.error(f"ERRO CRÍTICO AO RENDERIZAR MANUALMENTE '{template_name}': {e}")
         # Retorna uma página de erro mais informativa
         error_html = f"""
         <!DOCTYPE html><html lang="pt-BR"><head><meta charset="UTF-8"><title>Erro 500</title></head>
@@ -254,31 +333,345 @@ def manual_render_template(template_name, status_code=200, **kwargs):
 
 
 def normalizar_texto(s: str) -> str:
-    s = s.translate(DASHES).replace("\u00A0", " ") # Substitui hífens e nbsp
-    s = "".join(ch for ch in s if ch not in "\u200B\u200C\u200D\uFEFF") # Remove ZWSP e similares
-    s = unicodedata.normalize("NFKC", s) # Normaliza caracteres unicode
-    return s
+    s = s.translate(TABELA_NORMALIZACAO) # Hífens, nbsp e ZWSP numa única passada
+    # NFKC só quando necessário: a maioria das páginas é ASCII ou já está normalizada
+    if s.isascii() or unicodedata.is_normalized("NFKC", s):
+        return s
+    return unicodedata.normalize("NFKC", s) # Normaliza caracteres unicode
+
+def iterar_paginas_pdf(stream_pdf):
+    """Gera (índice, total de páginas, texto da página) na ordem do documento."""
+    # Abre o PDF a partir do stream de bytes
+    with fitz.open(stream=stream_pdf, filetype="pdf") as doc:
+         total = len(doc)
+         # Itera sobre cada página e extrai o texto, mantendo a ordem
+         for page_num in range(total):
+             page = doc.load_page(page_num)
+             # get_text("text", sort=True) tenta ordenar o texto como lido visualmente
+             yield page_num, total, page.get_text("text", sort=True)
+
+# ==== Cabeçalhos e rodapés repetidos ====
+# Cada página repete cabeçalho e rodapé ("Remessa para Conferência", "Página N", "Banco"...), que
+# caem dentro do bloco do lote que atravessa a quebra de página. Antes do parse, as linhas das
+# bordas de cada página são contadas no documento (com os números trocados por '#', para "Página N"
+# casar entre páginas); as que se repetem na mesma posição na maioria das páginas saem uma vez aqui.
+# Linhas com código de lote, com valor monetário ou que marcam a estrutura do bloco nunca saem, nem
+# rótulos de parcela: os conhecidos (configuração e parcelas de resumo) e qualquer linha seguida de
+# uma linha só com o valor (o formato "Rótulo \n Valor" que extrair_parcelas aceita).
+#   REMOVER_CABECALHOS     -> "0" desliga a remoção
+#   CABECALHOS_ZONA_LINHAS -> linhas não vazias examinadas no topo e no fim de cada página (padrão: 3)
+REMOVER_CABECALHOS = os.environ.get('REMOVER_CABECALHOS', '1') != '0'
+CABECALHOS_ZONA_LINHAS = int(os.environ.get('CABECALHOS_ZONA_LINHAS', 3))
+CABECALHOS_MIN_PAGINAS = 3  # Com menos páginas não dá para separar cabeçalho de conteúdo
+CABECALHOS_FRACAO_MIN = 0.6 # Fração das páginas vistas em que a linha precisa se repetir
+_PADRAO_VALOR_MONETARIO = re.compile(r"\d[.,]\d{2}(?!\d)")
+_PADRAO_DIGITOS = re.compile(r"\d+")
+_LINHAS_ESTRUTURAIS = {"Lançamentos", "Débitos do Mês"}
+
+def _assinatura_linha(linha: str):
+    """Chave de contagem da linha (números mascarados), ou None se ela nunca pode ser removida."""
+    texto = linha.strip()
+    if texto in _LINHAS_ESTRUTURAIS or PADRAO_LOTE.search(texto) or _PADRAO_VALOR_MONETARIO.search(texto):
+        return None
+    return _PADRAO_DIGITOS.sub('#', texto)
+
+def _rotulos_de_parcela() -> set:
+    """Rótulos de parcela conhecidos (em maiúsculas), que a remoção de cabeçalhos nunca toca."""
+    cfg = carregar_config()
+    rotulos = set(cfg.get('BASE_FIXOS', {})) | set(BASE_FIXOS_CCB) | set(PARCELAS_FORA_DA_COMPARACAO)
+    for fixos in cfg.get('EMP_MAP', {}).values():
+        rotulos.update(fixos)
+    return {rotulo.upper() for rotulo in rotulos}
+
+def _e_rotulo_de_parcela(linhas: list, nao_vazias: list, k: int, rotulos: set) -> bool:
+    """A k-ésima linha não vazia é um rótulo conhecido ou vem antes de uma linha só com o valor?"""
+    if limpar_rotulo(linhas[nao_vazias[k]].strip()).upper() in rotulos:
+        return True
+    # Última linha da página: o valor estaria na página seguinte, e só o rótulo conhecido a protege
+    return k + 1 < len(nao_vazias) and bool(PADRAO_NUMERO_PURO.match(linhas[nao_vazias[k + 1]]))
+
+def _bordas_da_pagina(linhas: list, rotulos: set) -> dict:
+    """Índice da linha -> (borda, posição na borda, assinatura) das linhas do topo e do fim."""
+    nao_vazias = [i for i, linha in enumerate(linhas) if linha.strip()]
+    n_topo = min(CABECALHOS_ZONA_LINHAS, len(nao_vazias))
+    inicio_fim = max(n_topo, len(nao_vazias) - CABECALHOS_ZONA_LINHAS) # Sem sobrepor o topo
+    bordas = {}
+    for borda, posicoes in (('topo', range(n_topo)), ('fim', range(len(nao_vazias) - 1, inicio_fim - 1, -1))):
+        for posicao, k in enumerate(posicoes):
+            i = nao_vazias[k]
+            assinatura = _assinatura_linha(linhas[i])
+            if assinatura and not _e_rotulo_de_parcela(linhas, nao_vazias, k, rotulos):
+                bordas[i] = (borda, posicao, assinatura)
+    return bordas
+
+def remover_cabecalhos_repetidos(paginas):
+    """Recebe e gera (índice, total, texto) das páginas, sem as linhas de cabeçalho/rodapé repetidas.
+
+    A contagem é cumulativa: as primeiras CABECALHOS_MIN_PAGINAS páginas ficam retidas até haver
+    páginas suficientes e, depois disso, cada página sai assim que chega, filtrada pela contagem até
+    ela. Assim a validação progressiva e a extração completa removem exatamente as mesmas linhas.
+    """
+    contagem = Counter()  # (borda, posição, assinatura) -> páginas em que apareceu
+    removidas = Counter() # assinatura -> páginas de onde saiu
+    retidas = deque()
+    vistas = 0
+    rotulos = _rotulos_de_parcela()
+
+    def filtrar(indice, total, linhas, bordas):
+        limiar = max(CABECALHOS_MIN_PAGINAS, CABECALHOS_FRACAO_MIN * vistas)
+        descartar = {i for i, chave in bordas.items() if contagem[chave] >= limiar}
+        for i in descartar:
+            removidas[bordas[i][2]] += 1
+        return indice, total, "\n".join(linha for i, linha in enumerate(linhas) if i not in descartar)
+
+    for indice, total, texto in paginas:
+        linhas = texto.split("\n")
+        bordas = _bordas_da_pagina(linhas, rotulos)
+        contagem.update(set(bordas.values()))
+        vistas += 1
+        retidas.append((indice, total, linhas, bordas))
+        if vistas >= CABECALHOS_MIN_PAGINAS:
+            while retidas:
+                yield filtrar(*retidas.popleft())
+    while retidas:
+        yield filtrar(*retidas.popleft())
+
+    if removidas:
+        log.info("[CABECALHOS] %d linha(s) repetida(s) removida(s) em %d página(s): %s", sum(removidas.values()), vistas,
+                 "; ".join(f"'{assinatura}' x{n}" for assinatura, n in removidas.most_common(10)))
+
+# ==== Extração isolada em subprocessos ====
+# Um PDF malformado ou gigante pode travar o get_text por minutos ou alocar gigabytes. A extração
+# roda em processos filhos reaproveitados, com limite de CPU e de memória por job e um prazo de
+# relógio; se algo estourar, só o filho morre e a requisição recebe uma página de erro. A contagem
+# de páginas da admissão também roda nesses filhos: o PDF não é aberto na thread do gunicorn.
+#   EXTRACAO_ISOLADA    -> "0" extrai no próprio processo (desenvolvimento local)
+#   EXTRACAO_WORKERS    -> processos de extração por worker do gunicorn (padrão: 2)
+#   EXTRACAO_TIMEOUT_S  -> prazo de relógio por PDF (padrão: 120, abaixo do timeout do gunicorn)
+#   EXTRACAO_CONTAGEM_TIMEOUT_S -> prazo da contagem de páginas da admissão, que tem vaga própria (padrão: 15)
+#   EXTRACAO_CPU_S      -> tempo de CPU por PDF (padrão: 90)
+#   EXTRACAO_MEMORIA_MB -> memória adicional que um job pode alocar (padrão: 1024)
+try:
+    import resource
+except ImportError: # Fora do POSIX os limites não se aplicam; resta o prazo de relógio
+    resource = None
+
+EXTRACAO_ISOLADA    = os.environ.get('EXTRACAO_ISOLADA', '1') != '0'
+EXTRACAO_WORKERS    = int(os.environ.get('EXTRACAO_WORKERS', 2))
+EXTRACAO_TIMEOUT_S  = float(os.environ.get('EXTRACAO_TIMEOUT_S', 120))
+EXTRACAO_CONTAGEM_TIMEOUT_S = float(os.environ.get('EXTRACAO_CONTAGEM_TIMEOUT_S', 15))
+EXTRACAO_CPU_S      = int(os.environ.get('EXTRACAO_CPU_S', 90))
+EXTRACAO_MEMORIA_MB = int(os.environ.get('EXTRACAO_MEMORIA_MB', 1024))
+
+class ErroExtracaoPdf(Exception):
+    """O PDF não pôde ser extraído (arquivo inválido, tempo ou memória esgotados)."""
+
+def _worker_extracao(conexao, memoria_mb: int):
+    """Laço do processo filho: recebe (operação, segundos de CPU) e os bytes do PDF.
+
+    'extrair' devolve as páginas; 'contar' devolve só o total de páginas (estimativa da admissão).
+    """
+    if resource is not None:
+        # O limite de endereçamento é relativo ao que o processo já usa (pandas/numpy reservam bastante)
+        atual = os.sysconf('SC_PAGE_SIZE') * int(open('/proc/self/statm').read().split()[0]) if os.path.exists('/proc/self/statm') else 0
+        limite = atual + memoria_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    while True:
+        try:
+            operacao, cpu_s = conexao.recv()
+            pdf_bytes = conexao.recv_bytes()
+        except EOFError:
+            return
+        if resource is not None:
+            # O processo é reaproveitado: o limite de CPU conta a partir do uso acumulado até aqui
+            uso = resource.getrusage(resource.RUSAGE_SELF)
+            resource.setrlimit(resource.RLIMIT_CPU, (int(uso.ru_utime + uso.ru_stime) + cpu_s,
+                                                     resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        try:
+            if operacao == 'contar':
+                with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                    conexao.send(('paginas', doc.page_count))
+            else:
+                for indice, total, texto_pagina in iterar_paginas_pdf(pdf_bytes):
+                    conexao.send(('pagina', indice, total, normalizar_texto(texto_pagina)))
+            conexao.send(('fim',))
+        except MemoryError:
+            # O heap pode ter ficado fragmentado: avisa que não é reutilizável e encerra
+            conexao.send(('erro', "O PDF excedeu o limite de memória da extração.", False))
+            return
+        except Exception as e:
+            conexao.send(('erro', f"{type(e).__name__} - {e}", True))
+
+class ExtratorIsolado:
+    """Supervisiona os processos de extração: reaproveita, aplica o prazo e substitui os que morrem."""
+
+    def __init__(self, max_workers: int, timeout_s: float, cpu_s: int, memoria_mb: int, contagem_timeout_s: float):
+        self.timeout_s = timeout_s
+        self.contagem_timeout_s = contagem_timeout_s
+        self.cpu_s = cpu_s
+        self.memoria_mb = memoria_mb
+        metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._ctx = multiprocessing.get_context(metodo)
+        self._vagas = threading.BoundedSemaphore(max_workers)
+        # A contagem de páginas não espera atrás das extrações em andamento (no máximo um processo a mais)
+        self._vaga_contagem = threading.BoundedSemaphore(1)
+        self._lock = threading.Lock()
+        self._livres = [] # (processo, conexão) ociosos
+        self._contadores = {'jobs': 0, 'erros': 0, 'timeouts': 0, 'crashes': 0, 'processos_criados': 0}
+
+    def _contar(self, nome: str):
+        with self._lock:
+            self._contadores[nome] += 1
+
+    def _obter_worker(self):
+        with self._lock:
+            while self._livres:
+                processo, conexao = self._livres.pop()
+                if processo.is_alive():
+                    return processo, conexao
+                conexao.close()
+            self._contadores['processos_criados'] += 1
+        conexao, conexao_filho = self._ctx.Pipe()
+        processo = self._ctx.Process(target=_worker_extracao, args=(conexao_filho, self.memoria_mb), daemon=True)
+        processo.start()
+        conexao_filho.close()
+        return processo, conexao
+
+    @staticmethod
+    def _descartar(worker):
+        processo, conexao = worker
+        if processo.is_alive():
+            processo.kill()
+        processo.join(timeout=5)
+        conexao.close()
+
+    def _conduzir(self, operacao: str, conteudo, timeout_s: float, vagas, saida: queue.Queue):
+        """Roda o job até o fim numa thread própria, pondo as mensagens em `saida` (e no fim a exceção ou None).
+
+        A thread só espera pelo filho, então o prazo mede só a extração, e a vaga volta assim que o
+        filho termina, sem esperar o parse, a validação ou um cliente lento consumirem as páginas.
+        """
+        self._contar('jobs')
+        worker, concluido, erro = None, False, None
+        try:
+            worker = self._obter_worker()
+            processo, conexao = worker
+            conexao.send((operacao, self.cpu_s))
+            conexao.send_bytes(conteudo) # Sem pickle: o memoryview de um upload vai direto para o pipe
+            prazo = time.monotonic() + timeout_s
+            while True:
+                restante = prazo - time.monotonic()
+                if restante <= 0 or not conexao.poll(restante):
+                    self._contar('timeouts')
+                    log.warning(f"[EXTRACAO] Prazo de {timeout_s:.0f}s esgotado ({operacao}); processo {processo.pid} encerrado.")
+                    raise ErroExtracaoPdf(f"A leitura do PDF passou do tempo limite de {timeout_s:.0f} segundos. "
+                                          "O arquivo pode estar corrompido ou ser grande demais.")
+                try:
+                    mensagem = conexao.recv()
+                except (EOFError, OSError):
+                    processo.join(timeout=5)
+                    self._contar('crashes')
+                    log.error(f"[EXTRACAO] Processo {processo.pid} morreu durante a extração (exitcode={processo.exitcode}).")
+                    raise ErroExtracaoPdf("A leitura do PDF foi interrompida por exceder os limites de CPU ou memória, "
+                                          "ou o arquivo está malformado.")
+                if mensagem[0] == 'fim':
+                    concluido = True
+                    return
+                elif mensagem[0] == 'erro':
+                    self._contar('erros')
+                    concluido = mensagem[2] # Erro tratado no filho: ele continua utilizável?
+                    raise ErroExtracaoPdf(f"Não foi possível ler o PDF: {mensagem[1]}")
+                saida.put(mensagem)
+        except BaseException as e:
+            erro = e
+        finally:
+            if worker is not None:
+                if concluido and worker[0].is_alive():
+                    with self._lock:
+                        self._livres.append(worker)
+                else:
+                    self._descartar(worker) # Prazo ou crash
+            vagas.release()
+            saida.put(erro)
+
+    def _executar(self, operacao: str, conteudo, timeout_s: float, vagas):
+        """Gera as mensagens de resultado do job. Quem chama já reservou `vagas`; a thread do job a devolve.
+
+        Se o consumidor desistir no meio, o job termina sozinho (dentro do prazo) e o processo é reaproveitado.
+        """
+        saida = queue.Queue()
+        try:
+            threading.Thread(target=contextvars.copy_context().run, daemon=True, name=f"extracao-{operacao}",
+                             args=(self._conduzir, operacao, conteudo, timeout_s, vagas, saida)).start()
+        except BaseException:
+            vagas.release()
+            raise
+        while True:
+            item = saida.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def iterar_paginas(self, pdf_bytes: bytes):
+        """Gera (índice, total, texto normalizado) à medida que o processo filho extrai as páginas."""
+        self._vagas.acquire()
+        for mensagem in self._executar('extrair', pdf_bytes, self.timeout_s, self._vagas):
+            yield mensagem[1:]
+
+    def contar_paginas(self, conteudo) -> int:
+        """Total de páginas do PDF, aberto no processo filho com os mesmos limites e um prazo curto.
+
+        Usa a vaga própria da contagem; se ela não vagar dentro do prazo, retorna 0 (custo só pelo tamanho).
+        """
+        if not self._vaga_contagem.acquire(timeout=self.contagem_timeout_s):
+            log.warning(f"[EXTRACAO] Sem vaga para contar páginas em {self.contagem_timeout_s:.0f}s; custo estimado só pelo tamanho.")
+            return 0
+        paginas = 0
+        for mensagem in self._executar('contar', conteudo, self.contagem_timeout_s, self._vaga_contagem):
+            paginas = mensagem[1]
+        return paginas
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return dict(self._contadores, ociosos=len(self._livres))
+
+EXTRATOR_PDF = ExtratorIsolado(EXTRACAO_WORKERS, EXTRACAO_TIMEOUT_S, EXTRACAO_CPU_S, EXTRACAO_MEMORIA_MB, EXTRACAO_CONTAGEM_TIMEOUT_S)
+
+def extrair_paginas(stream_pdf):
+    """Gera (índice, total, texto normalizado) de cada página, isolando a extração se configurado."""
+    if EXTRACAO_ISOLADA:
+        paginas = EXTRATOR_PDF.iterar_paginas(stream_pdf)
+    else:
+        paginas = ((indice, total, normalizar_texto(texto_pagina)) for indice, total, texto_pagina in iterar_paginas_pdf(stream_pdf))
+    yield from (remover_cabecalhos_repetidos(paginas) if REMOVER_CABECALHOS else paginas)
 
 def extrair_texto_pdf(stream_pdf) -> str:
-    texto_completo = ""
+    """Texto normalizado do PDF. Levanta ErroExtracaoPdf se a extração estourar prazo ou limites."""
     try:
-        # Abre o PDF a partir do stream de bytes
-        with fitz.open(stream=stream_pdf, filetype="pdf") as doc:
-             # Itera sobre cada página e extrai o texto, mantendo a ordem
-             for page_num in range(len(doc)):
-                 page = doc.load_page(page_num)
-                 # get_text("text", sort=True) tenta ordenar o texto como lido visualmente
-                 texto_pagina = page.get_text("text", sort=True)
-                 texto_completo += texto_pagina + "\n" # Adiciona nova linha entre páginas
-        return normalizar_texto(texto_completo)
+        # Normaliza página a página (o NFKC é estável nas quebras de linha entre páginas)
+        return "".join(texto_pagina + "\n" for _, _, texto_pagina in extrair_paginas(stream_pdf)) # Adiciona nova linha entre páginas
+    except ErroExtracaoPdf:
+        raise
     except Exception as e:
-        print(f"Erro detalhado ao ler o stream do PDF: {type(e).__name__} - {e}")
-        traceback.print_exc() # Imprime o stack trace completo no log
+        log.exception(f"Erro detalhado ao ler o stream do PDF: {type(e).__name__} - {e}")
         return "" # Retorna string vazia em caso de erro
 
+def extrair_textos_pdfs(lista_pdf_bytes: list) -> list:
+    """Extrai vários PDFs ao mesmo tempo, cada um num processo de extração (na ordem recebida)."""
+    if not EXTRACAO_ISOLADA or len(lista_pdf_bytes) < 2:
+        return [extrair_texto_pdf(pdf_bytes) for pdf_bytes in lista_pdf_bytes] # PyMuPDF não é thread-safe
+    with ThreadPoolExecutor(max_workers=EXTRACAO_WORKERS) as executor:
+        # Cada thread leva uma cópia do contexto para manter o id de correlação nos logs
+        futuros = [executor.submit(contextvars.copy_context().run, extrair_texto_pdf, pdf_bytes) for pdf_bytes in lista_pdf_bytes]
+        return [futuro.result() for futuro in futuros]
+
 # =======================================================
 # === FUNÇÃO DE CONVERSÃO DE VALOR UNIFICADA E CORRIGIDA ===
 # =======================================================
+_falhas_normalizacao = threading.local() # Contador por thread de valores não convertidos
+
 def normalizar_valor(valor):
     """Converte string para float, lidando com formatos , e . como decimal."""
     if valor is None:
@@ -312,15 +705,72 @@ def normalizar_valor(valor):
     try:
         return round(float(s_norm), 2)
     except (ValueError, TypeError):
-        print(f"[AVISO] Falha ao normalizar valor: '{valor}' -> '{s_norm}'")
+        # Um aviso por valor inunda o log; parsear_bloco agrega as falhas por lote
+        _falhas_normalizacao.total = getattr(_falhas_normalizacao, 'total', 0) + 1
+        log.debug("Falha ao normalizar valor: '%s' -> '%s'", valor, s_norm)
         return 0.0 # Retorna 0.0 em caso de falha de conversão
 # =======================================================
 # === FIM DA FUNÇÃO UNIFICADA ===
 # =======================================================
 
-def fixos_do_emp(emp: str, modo_separacao: str):
+# ==== Chaves de lote ====
+# O código do lote (ex.: "04.AB.123") é decomposto uma vez e vira um inteiro que ordena na ordem
+# natural (prefixo, quadra, número), em vez da ordem de texto em que "04.A1.100" vem antes de "04.A1.20":
+#   [prefixo: 14 bits][dígitos do prefixo: 2][quadra: 2 x 6 bits][número: 14 bits][dígitos do número: 2]
+# Os dígitos entram na chave para "04.A1.62" e "04.A1.062" continuarem distintos. A tabela de
+# internação guarda uma única cópia de cada código e o prefixo já separado.
+_ALFABETO_QUADRA = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZΙΚ" # Mesma ordem dos códigos Unicode
+_POSICAO_QUADRA = {c: i for i, c in enumerate(_ALFABETO_QUADRA)}
+_BITS_ABAIXO_DO_PREFIXO = 30
+_CHAVE_FORA_DO_PADRAO = 1 << 44 # Acima de todas as chaves empacotadas
+LOTES_INTERNADOS_MAX = 200_000
+_lotes_internados = {} # código -> (chave, código internado, prefixo)
+_lotes_lock = threading.Lock()
+
+def _empacotar_lote(lote: str):
+    """Chave inteira do código, ou None se ele não seguir o formato prefixo.quadra.número."""
+    partes = lote.split('.')
+    if len(partes) != 3 or len(partes[1]) != 2:
+        return None
+    prefixo, quadra, numero = partes
+    if not (2 <= len(prefixo) <= 4 and 1 <= len(numero) <= 4 and (prefixo + numero).isascii()
+            and prefixo.isdigit() and numero.isdigit() and all(c in _POSICAO_QUADRA for c in quadra)):
+        return None
+    chave = int(prefixo)
+    chave = (chave << 2) | (len(prefixo) - 2)
+    chave = (chave << 6) | _POSICAO_QUADRA[quadra[0]]
+    chave = (chave << 6) | _POSICAO_QUADRA[quadra[1]]
+    chave = (chave << 14) | int(numero)
+    return (chave << 2) | (len(numero) - 1)
+
+def internar_lote(lote: str):
+    """Registra o código na tabela (uma vez) e retorna (chave, código internado, prefixo)."""
+    info = _lotes_internados.get(lote)
+    if info is not None:
+        return info
+    with _lotes_lock:
+        info = _lotes_internados.get(lote)
+        if info is not None:
+            return info
+        if len(_lotes_internados) >= LOTES_INTERNADOS_MAX:
+            _lotes_internados.clear() # É só um cache: os códigos voltam conforme aparecem
+        chave = _empacotar_lote(lote)
+        if chave is None:
+            # Fora do padrão: ordena depois dos lotes válidos, na ordem de chegada
+            chave = _CHAVE_FORA_DO_PADRAO + len(_lotes_internados)
+        lote = sys.intern(lote)
+        info = (chave, lote, lote.split('.')[0])
+        _lotes_internados[lote] = info
+        return info
+
+def chave_lote(lote: str) -> int:
+    """Chave inteira do lote, na ordem natural dos códigos."""
+    return internar_lote(lote)[0]
+
+def fixos_do_emp(emp: str, modo_separacao: str, cfg: dict = None):
     """Retorna o dicionário de parcelas fixas esperadas com base no empreendimento e modo."""
-    cfg = carregar_config()
+    if cfg is None:
+        cfg = carregar_config()
     emp_map   = cfg.get('EMP_MAP', CONFIG_PADRAO['EMP_MAP'])
     base_fixos = {k: ([float(x) for x in v] if isinstance(v, list) else [float(v)]) for k, v in cfg.get('BASE_FIXOS', CONFIG_PADRAO['BASE_FIXOS']).items()}
 
@@ -339,7 +789,7 @@ def fixos_do_emp(emp: str, modo_separacao: str):
     elif modo_separacao == 'ccb_realiza':
         return BASE_FIXOS_CCB
     else:
-        print(f"[AVISO] Modo de separação desconhecido '{modo_separacao}' em fixos_do_emp.")
+        log.warning(f"Modo de separação desconhecido '{modo_separacao}' em fixos_do_emp.")
         return {}
 
 def detectar_emp_por_nome_arquivo(path: str):
@@ -359,9 +809,8 @@ def detectar_emp_por_lote(lote: str):
     """Detecta o empreendimento com base no prefixo do código do lote."""
     if not lote or "." not in lote:
         return "NAO_CLASSIFICADO"
-    prefixo = lote.split('.')[0]
-    # Retorna o código do mapa ou "NAO_CLASSIFICADO" se não encontrar
-    return CODIGO_EMP_MAP.get(prefixo, "NAO_CLASSIFICADO")
+    # Prefixo já separado na tabela de lotes; retorna o código do mapa ou "NAO_CLASSIFICADO"
+    return CODIGO_EMP_MAP.get(internar_lote(lote)[2], "NAO_CLASSIFICADO")
 
 def limpar_rotulo(lbl: str) -> str:
     """Remove prefixos e sufixos comuns dos rótulos das parcelas."""
@@ -380,7 +829,7 @@ def fatiar_blocos(texto: str):
     blocos = []
     # Itera sobre as correspondências para extrair o texto entre elas
     for i, match in enumerate(matches):
-        lote_atual = match.group(1)
+        lote_atual = internar_lote(match.group(1))[1] # Uma cópia de cada código entre páginas e meses
         inicio_bloco = match.start()
         # Fim do bloco é o início do próximo lote, ou o final do texto se for o último
         fim_bloco = matches[i+1].start() if i+1 < len(matches) else len(texto_processado)
@@ -389,9 +838,30 @@ def fatiar_blocos(texto: str):
         if texto_bloco: # Adiciona apenas se o bloco não estiver vazio
              blocos.append((lote_atual, texto_bloco))
     if not blocos:
-         print("[AVISO] Nenhum bloco de lote encontrado no PDF.")
+         log.warning("Nenhum bloco de lote encontrado no PDF.")
     return blocos
 
+def fatiar_blocos_incremental(paginas):
+    """Como fatiar_blocos, mas consome o texto página a página.
+
+    Gera, para cada página, a lista dos blocos que ela completou (pode ser vazia). Um bloco só
+    está completo quando o próximo código de lote aparece, então o último bloco visto fica no
+    buffer até a página seguinte; ele sai na lista extra gerada no fim do documento.
+    """
+    buffer = ""
+    algum_bloco = False
+    for texto_pagina in paginas:
+        buffer += texto_pagina
+        matches = list(PADRAO_LOTE.finditer(buffer))
+        if len(matches) < 2:
+            yield []
+            continue
+        corte = matches[-1].start()
+        yield fatiar_blocos(buffer[:corte])
+        algum_bloco = True
+        buffer = buffer[corte:]
+    yield fatiar_blocos(buffer) if PADRAO_LOTE.search(buffer) or not algum_bloco else []
+
 def tentar_nome_cliente(bloco: str) -> str:
     """Tenta extrair o nome do cliente das primeiras linhas do bloco."""
     linhas = bloco.split('\n')
@@ -484,48 +954,74 @@ def extrair_parcelas(bloco: str):
                            continue # Pula para a próxima linha i
     return itens
 
-def processar_pdf_validacao(texto_pdf: str, modo_separacao: str, emp_fixo_boleto: str = None):
-    """Processa o texto do PDF para validação."""
-    blocos = fatiar_blocos(texto_pdf)
-    if not blocos: return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-    linhas_todas, linhas_cov, linhas_div = [], [], []
-    for lote, bloco in blocos:
-        if modo_separacao == 'boleto':
-            emp_atual = detectar_emp_por_lote(lote) if emp_fixo_boleto == "SBRR" else emp_fixo_boleto
-        else:
-            emp_atual = detectar_emp_por_lote(lote)
-
-        cliente = tentar_nome_cliente(bloco)
-        itens = extrair_parcelas(bloco)
-        VALORES_CORRETOS = fixos_do_emp(emp_atual, modo_separacao) # Passa o modo
-
-        for rot, val in itens.items():
-            # 'val' já é um float corrigido pela função normalizar_valor
-            linhas_todas.append({"Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente, "Parcela": rot, "Valor": val})
+def parsear_lotes(texto_pdf: str, modo_separacao: str, emp_fixo_boleto: str = None) -> list:
+    """Extrai de cada bloco do PDF o empreendimento, lote, cliente e parcelas (sem validar)."""
+    return [parsear_bloco(lote, bloco, modo_separacao, emp_fixo_boleto) for lote, bloco in fatiar_blocos(texto_pdf)]
 
-        cov = {"Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente}
-        for k in VALORES_CORRETOS.keys(): cov[k] = None # Inicializa colunas
-        for rot, val in itens.items():
-            if rot in VALORES_CORRETOS: cov[rot] = val # Preenche valores encontrados
+def emp_do_lote(lote: str, modo_separacao: str, emp_fixo_boleto: str = None):
+    """Empreendimento de um lote: o do nome do arquivo no modo Boleto, senão o do prefixo."""
+    if modo_separacao == 'boleto':
+        return detectar_emp_por_lote(lote) if emp_fixo_boleto == "SBRR" else emp_fixo_boleto
+    return detectar_emp_por_lote(lote)
+
+def parsear_bloco(lote: str, bloco: str, modo_separacao: str, emp_fixo_boleto: str = None) -> dict:
+    falhas_antes = getattr(_falhas_normalizacao, 'total', 0)
+    registro = {
+        "Empreendimento": emp_do_lote(lote, modo_separacao, emp_fixo_boleto), "Lote": lote,
+        "Cliente": tentar_nome_cliente(bloco),
+        "Itens": list(extrair_parcelas(bloco).items()), # Lista de pares para manter a ordem no JSON
+    }
+    falhas = getattr(_falhas_normalizacao, 'total', 0) - falhas_antes
+    if falhas:
+        log.warning("%d valor(es) não puderam ser convertidos no lote %s (considerados 0,00).", falhas, lote)
+    return registro
+
+def validar_lote(registro: dict, modo_separacao: str, cfg: dict):
+    """Valida um lote parseado. Retorna (linhas de parcelas, linha de cobertura, linhas de divergência)."""
+    emp_atual, lote, cliente = registro["Empreendimento"], registro["Lote"], registro["Cliente"]
+    itens = OrderedDict(registro["Itens"])
+    VALORES_CORRETOS = fixos_do_emp(emp_atual, modo_separacao, cfg) # Passa o modo
+
+    linhas_todas, linhas_div = [], []
+    for rot, val in itens.items():
+        # 'val' já é um float corrigido pela função normalizar_valor
+        linhas_todas.append({"Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente, "Parcela": rot, "Valor": val})
+
+    cov = {"Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente}
+    for k in VALORES_CORRETOS.keys(): cov[k] = None # Inicializa colunas
+    for rot, val in itens.items():
+        if rot in VALORES_CORRETOS: cov[rot] = val # Preenche valores encontrados
+
+    vistos = [k for k in VALORES_CORRETOS if cov[k] is not None]
+    cov["QtdParc_Alvo"] = len(vistos)
+    cov["Parc_Alvo"] = ", ".join(vistos)
+
+    # Validação de valor (apenas se houver valores permitidos definidos)
+    if modo_separacao != 'ccb_realiza': # Não valida valores para CCB (lista vazia)
+        for rot in vistos:
+            val = cov[rot]
+            if val is None: continue
+            permitidos = VALORES_CORRETOS.get(rot, [])
+            if permitidos and all(abs(val - v) > 1e-6 for v in permitidos):
+                linhas_div.append({
+                    "Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente,
+                    "Parcela": rot, "Valor no Documento": float(val), # val já é float
+                    "Valor Correto": " ou ".join(f"{v:.2f}" for v in permitidos)
+                })
+    return linhas_todas, cov, linhas_div
+
+def validar_lotes(lotes: list, modo_separacao: str, cfg: dict = None):
+    """Valida os lotes já parseados contra a configuração (atual, se `cfg` não for informado)."""
+    if not lotes: return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    if cfg is None:
+        cfg = carregar_config() # Lido uma vez por validação, não por lote
 
-        vistos = [k for k in VALORES_CORRETOS if cov[k] is not None]
-        cov["QtdParc_Alvo"] = len(vistos)
-        cov["Parc_Alvo"] = ", ".join(vistos)
+    linhas_todas, linhas_cov, linhas_div = [], [], []
+    for registro in lotes:
+        todas, cov, div = validar_lote(registro, modo_separacao, cfg)
+        linhas_todas.extend(todas)
         linhas_cov.append(cov)
-
-        # Validação de valor (apenas se houver valores permitidos definidos)
-        if modo_separacao != 'ccb_realiza': # Não valida valores para CCB (lista vazia)
-            for rot in vistos:
-                val = cov[rot]
-                if val is None: continue
-                permitidos = VALORES_CORRETOS.get(rot, [])
-                if permitidos and all(abs(val - v) > 1e-6 for v in permitidos):
-                    linhas_div.append({
-                        "Empreendimento": emp_atual, "Lote": lote, "Cliente": cliente,
-                        "Parcela": rot, "Valor no Documento": float(val), # val já é float
-                        "Valor Correto": " ou ".join(f"{v:.2f}" for v in permitidos)
-                    })
+        linhas_div.extend(div)
 
     df_todas = pd.DataFrame(linhas_todas)
     df_cov = pd.DataFrame(linhas_cov)
@@ -533,43 +1029,228 @@ def processar_pdf_validacao(texto_pdf: str, modo_separacao: str, emp_fixo_boleto
 
     return df_todas, df_cov, df_div
 
-def processar_comparativo(texto_anterior, texto_atual, modo_separacao, emp_fixo_boleto):
-    """Compara os dados extraídos de dois PDFs."""
-    df_todas_ant_raw, _, _ = processar_pdf_validacao(texto_anterior, modo_separacao, emp_fixo_boleto)
-    df_todas_atu_raw, _, _ = processar_pdf_validacao(texto_atual, modo_separacao, emp_fixo_boleto)
-
-    # Extrai totais (agora com valores corretos de normalizar_valor)
-    df_totais_ant = df_todas_ant_raw[df_todas_ant_raw['Parcela'].astype(str).str.strip().str.upper() == 'TOTAL A PAGAR'].copy()
-    df_totais_ant = df_totais_ant[['Empreendimento', 'Lote', 'Cliente', 'Valor']].rename(columns={'Valor': 'Total Anterior'})
-
-    df_totais_atu = df_todas_atu_raw[df_todas_atu_raw['Parcela'].astype(str).str.strip().str.upper() == 'TOTAL A PAGAR'].copy()
-    df_totais_atu = df_totais_atu[['Empreendimento', 'Lote', 'Cliente', 'Valor']].rename(columns={'Valor': 'Total Atual'})
+def processar_pdf_validacao(texto_pdf: str, modo_separacao: str, emp_fixo_boleto: str = None):
+    """Processa o texto do PDF para validação."""
+    return validar_lotes(parsear_lotes(texto_pdf, modo_separacao, emp_fixo_boleto), modo_separacao)
+
+# ==== Comparativo particionado por empreendimento ====
+# As linhas só se cruzam dentro do mesmo (Empreendimento, Lote), então cada partição
+# (empreendimento, prefixo do lote) é parseada e comparada de forma independente, num pool de
+# processos. Os merges usam inteiros: a posição de cada (Empreendimento, Lote, Cliente) no índice
+# ordenado pela chave natural do lote e a de cada rótulo de parcela; as linhas saem em ordem natural
+# de lote e, concatenando as partições na ordem das chaves, o relatório inteiro também. Os totais
+# são somados na ordem original dos blocos.
+# A série de N meses usa as mesmas partições: cada mês é parseado uma vez por partição, os meses
+# consecutivos são comparados como no comparativo simples (N=2) e um k-way merge monta a matriz.
+#   COMPARATIVO_PROCESSOS       -> processos do pool (padrão: núcleos disponíveis)
+#   COMPARATIVO_MIN_BLOCOS_POOL -> abaixo disso roda no próprio processo (padrão: 400)
+#   COMPARATIVO_MAX_MESES       -> arquivos aceitos na série de meses (padrão: 12)
+COMPARATIVO_PROCESSOS = int(os.environ.get('COMPARATIVO_PROCESSOS', os.cpu_count() or 1))
+COMPARATIVO_MIN_BLOCOS_POOL = int(os.environ.get('COMPARATIVO_MIN_BLOCOS_POOL', 400))
+COMPARATIVO_MAX_MESES = int(os.environ.get('COMPARATIVO_MAX_MESES', 12))
+CHAVES_COMPARACAO = ['Empreendimento', 'Lote', 'Cliente', 'Parcela']
+CHAVES_LOTE = ['Empreendimento', 'Lote', 'Cliente']
+PARCELAS_FORA_DA_COMPARACAO = ['TOTAL A PAGAR', 'DESCONTO', 'DÉBITOS DO MÊS', 'DÉBITOS DO MÊS ANTERIOR', 'ENCARGOS POR ATRASO', 'PAGAMENTO EFETUADO']
+
+_pool_comparativo = None
+_pool_comparativo_lock = threading.Lock()
+
+def _obter_pool_comparativo():
+    """Pool reaproveitado entre requisições. 'forkserver' evita herdar locks das threads do gunicorn."""
+    global _pool_comparativo
+    with _pool_comparativo_lock:
+        if _pool_comparativo is None:
+            metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool_comparativo = ProcessPoolExecutor(max_workers=COMPARATIVO_PROCESSOS,
+                                                    mp_context=multiprocessing.get_context(metodo))
+        return _pool_comparativo
+
+def _descartar_pool_comparativo(pool):
+    """Tira de uso um pool quebrado (filho morto por OOM/SIGKILL); o próximo uso cria outro."""
+    global _pool_comparativo
+    with _pool_comparativo_lock:
+        if _pool_comparativo is pool: # Outra thread pode já ter trocado o pool
+            _pool_comparativo = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _particionar_blocos(texto: str, modo_separacao: str, emp_fixo_boleto: str) -> dict:
+    """Agrupa os blocos por (empreendimento, prefixo do lote), guardando a posição original."""
+    particoes = {}
+    for ordem, (lote, bloco) in enumerate(fatiar_blocos(texto)):
+        chave, _, prefixo = internar_lote(lote)
+        # O prefixo numérico (bits acima da quadra) ordena as partições na ordem natural
+        chave = (emp_do_lote(lote, modo_separacao, emp_fixo_boleto) or '', chave >> _BITS_ABAIXO_DO_PREFIXO, prefixo)
+        particoes.setdefault(chave, []).append((ordem, lote, bloco))
+    return particoes
+
+def _ordem_lote(chave: tuple):
+    """Ordem de um (Empreendimento, Lote, Cliente) no índice: empreendimento, lote natural, cliente."""
+    emp, lote, cliente = chave
+    return (emp or '', chave_lote(lote), cliente)
+
+def _df_chaves(linhas: list, colunas: list) -> pd.DataFrame:
+    # Colunas e dtypes explícitos: uma partição pode não ter lotes em um dos meses
+    tipos = {c: ('int64' if c.startswith('_') else 'float64') for c in colunas}
+    return pd.DataFrame(linhas, columns=colunas).astype(tipos)
+
+def _com_colunas_texto(df: pd.DataFrame, lotes: list, parcelas: list = None) -> pd.DataFrame:
+    """Troca as chaves inteiras do merge pelas colunas de texto do relatório, na frente das demais."""
+    ids_lote = df.pop('_lote').to_numpy()
+    for posicao, nome in enumerate(CHAVES_LOTE):
+        df.insert(posicao, nome, pd.Index([chave[posicao] for chave in lotes], dtype=object).take(ids_lote))
+    if parcelas is not None:
+        df.insert(len(CHAVES_LOTE), 'Parcela', pd.Index(parcelas, dtype=object).take(df.pop('_parcela').to_numpy()))
+    return df
+
+def impressao_digital_lote(parcelas: list):
+    """Hash estável do conjunto (Parcela, Valor) de um lote; None se houver parcela repetida."""
+    if len({rot for rot, _ in parcelas}) != len(parcelas):
+        return None # Parcelas repetidas se cruzam no merge e podem divergir entre si
+    conteudo = repr(sorted((str(rot), float(val)) for rot, val in parcelas))
+    return hashlib.blake2b(conteudo.encode('utf-8'), digest_size=16).digest()
+
+def _parsear_mes(blocos: list, modo_separacao: str, emp_fixo_boleto: str) -> dict:
+    """Parseia os blocos de um mês da partição, uma única vez, no formato usado pelas comparações."""
+    linhas_total, chaves = [], []
+    totais = []      # (posição do bloco, valor) para somar na ordem original
+    comparaveis = {} # chave do lote -> linhas comparáveis item a item
+    impressoes = {}  # chave do lote -> impressão digital das parcelas (None = comparar sempre)
+    for ordem, lote, bloco in blocos:
+        registro = parsear_bloco(lote, bloco, modo_separacao, emp_fixo_boleto)
+        chave = (registro["Empreendimento"], lote, registro["Cliente"])
+        if registro["Itens"]:
+            chaves.append(chave) # Lote sem parcelas não entra na contagem, como no DataFrame bruto
+        linhas_lote = []
+        for rot, val in registro["Itens"]:
+            parcela = str(rot).strip().upper()
+            if parcela == 'TOTAL A PAGAR':
+                totais.append((ordem, val))
+                linhas_total.append(chave + (val,))
+            if parcela not in PARCELAS_FORA_DA_COMPARACAO and not parcela.startswith('TOTAL BANCO'):
+                linhas_lote.append(chave + (rot, val))
+        if chave in comparaveis:
+            # Lote repetido no documento: o merge cruza as repetições, então não dá para pular
+            comparaveis[chave].extend(linhas_lote)
+            impressoes[chave] = None
+        else:
+            comparaveis[chave] = linhas_lote
+            impressoes[chave] = impressao_digital_lote([(l[3], l[4]) for l in linhas_lote])
+    return {'comparaveis': comparaveis, 'impressoes': impressoes, 'linhas_total': linhas_total,
+            'chaves': chaves, 'totais_seq': totais}
+
+def _comparar_meses(mes_ant: dict, mes_atu: dict) -> dict:
+    """Compara dois meses já parseados de uma partição (mês anterior -> mês atual)."""
+    # Índice ordenado dos lotes e dos rótulos: a posição de cada um é a chave inteira dos merges
+    lotes = sorted(mes_ant['comparaveis'].keys() | mes_atu['comparaveis'].keys(), key=_ordem_lote)
+    id_lote = {chave: posicao for posicao, chave in enumerate(lotes)}
+
+    # Extrai totais
+    df_totais_ant = _df_chaves([(id_lote[l[:3]], l[3]) for l in mes_ant['linhas_total']], ['_lote', 'Total Anterior'])
+    df_totais_atu = _df_chaves([(id_lote[l[:3]], l[3]) for l in mes_atu['linhas_total']], ['_lote', 'Total Atual'])
+
+    # Só os lotes cuja impressão digital mudou (ou que existem em um mês só) passam pelo merge
+    # item a item; nos demais todas as parcelas casam com o mesmo valor e não geram linhas.
+    impressoes_ant, impressoes_atu = mes_ant['impressoes'], mes_atu['impressoes']
+    def alterado(chave):
+        impressao = impressoes_ant.get(chave)
+        return impressao is None or impressao != impressoes_atu.get(chave)
+
+    linhas_ant = [l for chave, ls in mes_ant['comparaveis'].items() if alterado(chave) for l in ls]
+    linhas_atu = [l for chave, ls in mes_atu['comparaveis'].items() if alterado(chave) for l in ls]
+    parcelas = sorted({l[3] for l in linhas_ant} | {l[3] for l in linhas_atu})
+    id_parcela = {rot: posicao for posicao, rot in enumerate(parcelas)}
+    df_todas_ant = _df_chaves([(id_lote[l[:3]], id_parcela[l[3]], l[4]) for l in linhas_ant], ['_lote', '_parcela', 'Valor Anterior'])
+    df_todas_atu = _df_chaves([(id_lote[l[:3]], id_parcela[l[3]], l[4]) for l in linhas_atu], ['_lote', '_parcela', 'Valor Atual'])
+
+    # Merge para comparação (sort-merge de inteiros; sai na ordem do índice)
+    df_comp = _com_colunas_texto(pd.merge(df_todas_ant, df_todas_atu, on=['_lote', '_parcela'], how='outer'), lotes, parcelas)
 
-    # Remove parcelas indesejadas para comparação item a item
-    parcelas_para_remover = ['TOTAL A PAGAR', 'DESCONTO', 'DÉBITOS DO MÊS', 'DÉBITOS DO MÊS ANTERIOR', 'ENCARGOS POR ATRASO', 'PAGAMENTO EFETUADO']
-    df_todas_ant = df_todas_ant_raw[~df_todas_ant_raw['Parcela'].astype(str).str.strip().str.upper().isin(parcelas_para_remover)].copy()
-    df_todas_atu = df_todas_atu_raw[~df_todas_atu_raw['Parcela'].astype(str).str.strip().str.upper().isin(parcelas_para_remover)].copy()
+    # Identifica lotes adicionados/removidos
+    lotes_ant = _df_chaves([(id_lote[c],) for c in dict.fromkeys(mes_ant['chaves'])], ['_lote'])
+    lotes_atu = _df_chaves([(id_lote[c],) for c in dict.fromkeys(mes_atu['chaves'])], ['_lote'])
+    lotes_merged = pd.merge(lotes_ant, lotes_atu, on='_lote', how='outer', indicator=True)
 
-    df_todas_ant = df_todas_ant[~df_todas_ant['Parcela'].astype(str).str.strip().str.upper().str.startswith('TOTAL BANCO')].copy()
-    df_todas_atu = df_todas_atu[~df_todas_atu['Parcela'].astype(str).str.strip().str.upper().str.startswith('TOTAL BANCO')].copy()
+    df_adicionados_base = lotes_merged[lotes_merged['_merge'] == 'right_only'][['_lote']]
+    df_removidos_base = lotes_merged[lotes_merged['_merge'] == 'left_only'][['_lote']]
 
-    df_todas_ant.rename(columns={'Valor': 'Valor Anterior'}, inplace=True)
-    df_todas_atu.rename(columns={'Valor': 'Valor Atual'}, inplace=True)
+    # Adiciona valor total aos lotes adicionados/removidos
+    df_adicionados = _com_colunas_texto(pd.merge(df_adicionados_base, df_totais_atu, on='_lote', how='left'), lotes)
+    df_removidos = _com_colunas_texto(pd.merge(df_removidos_base, df_totais_ant, on='_lote', how='left'), lotes)
 
-    # Merge para comparação
-    df_comp = pd.merge(df_todas_ant, df_todas_atu, on=['Empreendimento', 'Lote', 'Cliente', 'Parcela'], how='outer')
+    return {
+        'comp': df_comp, 'adicionados': df_adicionados, 'removidos': df_removidos,
+        'qtd_lotes_ant': len(lotes_ant), 'qtd_lotes_atu': len(lotes_atu),
+        'totais_seq_ant': mes_ant['totais_seq'], 'totais_seq_atu': mes_atu['totais_seq'],
+    }
 
-    # Identifica lotes adicionados/removidos
-    lotes_ant = df_todas_ant_raw[['Empreendimento', 'Lote', 'Cliente']].drop_duplicates()
-    lotes_atu = df_todas_atu_raw[['Empreendimento', 'Lote', 'Cliente']].drop_duplicates()
-    lotes_merged = pd.merge(lotes_ant, lotes_atu, on=['Empreendimento', 'Lote', 'Cliente'], how='outer', indicator=True)
+def _matriz_particao(meses: list) -> list:
+    """K-way merge dos meses por (Empreendimento, Lote, Parcela): uma linha com o valor de cada mês."""
+    fluxos = []
+    for indice, mes in enumerate(meses):
+        itens, ocorrencias = [], {}
+        for linhas in mes['comparaveis'].values():
+            for emp, lote, cliente, rot, val in linhas:
+                chave = (emp or '', chave_lote(lote), lote, str(rot)) # Lote em ordem natural
+                # Parcela repetida no lote: alinha as repetições pela ordem em que aparecem
+                ocorrencias[chave] = ocorrencias.get(chave, 0) + 1
+                itens.append((chave + (ocorrencias[chave],), indice, cliente, val))
+        itens.sort(key=lambda item: item[0])
+        fluxos.append(itens)
+
+    linhas, atual = [], None
+    for chave, indice, cliente, val in heapq.merge(*fluxos, key=lambda item: (item[0], item[1])):
+        if atual is None or atual[0] != chave:
+            atual = [chave, cliente, [None] * len(meses)]
+            linhas.append(atual)
+        atual[1] = cliente # Vale o nome do cliente no mês mais recente
+        atual[2][indice] = val
+    return [(emp, lote, cliente, rot, *valores) for (emp, _, lote, rot, _), cliente, valores in linhas]
+
+def _comparar_particao(tarefa):
+    """Parseia cada mês da partição uma vez e compara os meses consecutivos. Roda nos processos do pool."""
+    blocos_por_mes, modo_separacao, emp_fixo_boleto, com_matriz, id_correlacao = tarefa
+    ID_CORRELACAO.set(id_correlacao) # Logs do processo do pool com o id da requisição
+    meses = [_parsear_mes(blocos, modo_separacao, emp_fixo_boleto) for blocos in blocos_por_mes]
+    return {
+        'transicoes': [_comparar_meses(ant, atu) for ant, atu in zip(meses, meses[1:])],
+        'matriz': _matriz_particao(meses) if com_matriz else [],
+    }
 
-    df_adicionados_base = lotes_merged[lotes_merged['_merge'] == 'right_only'][['Empreendimento', 'Lote', 'Cliente']]
-    df_removidos_base = lotes_merged[lotes_merged['_merge'] == 'left_only'][['Empreendimento', 'Lote', 'Cliente']]
+def _somar_na_ordem_original(totais_seq: list) -> float:
+    # Soma de ponto flutuante depende da ordem: reproduz a do documento (sort estável por bloco)
+    return pd.Series([v for _, v in sorted(totais_seq, key=lambda t: t[0])], dtype='float64').sum()
+
+def _executar_particoes(textos: list, modo_separacao: str, emp_fixo_boleto: str, com_matriz: bool) -> list:
+    """Particiona os textos dos meses e roda _comparar_particao em cada partição, na ordem das chaves."""
+    particoes = [_particionar_blocos(texto, modo_separacao, emp_fixo_boleto) for texto in textos]
+    # A ordem das chaves (empreendimento, prefixo) segue a ordem lexicográfica do merge global
+    chaves = sorted(set().union(*particoes)) or [('', '')]
+    tarefas = [([p.get(k, []) for p in particoes], modo_separacao, emp_fixo_boleto, com_matriz, ID_CORRELACAO.get()) for k in chaves]
+
+    total_blocos = sum(len(blocos) for t in tarefas for blocos in t[0])
+    inicio = time.perf_counter()
+    if len(tarefas) > 1 and COMPARATIVO_PROCESSOS > 1 and total_blocos >= COMPARATIVO_MIN_BLOCOS_POOL:
+        for tentativa in (1, 2):
+            pool = _obter_pool_comparativo()
+            try:
+                resultados = list(pool.map(_comparar_particao, tarefas))
+                break
+            except BrokenProcessPool:
+                # Um processo do pool morreu: sem trocar o pool, todo comparativo seguinte falharia
+                log.error(f"[COMPARATIVO] Pool de processos quebrado (tentativa {tentativa}); recriando.")
+                _descartar_pool_comparativo(pool)
+                if tentativa == 2:
+                    raise
+    else:
+        resultados = [_comparar_particao(t) for t in tarefas]
+    log.info(f"[COMPARATIVO] {len(textos)} mês(es), {len(tarefas)} partição(ões), {total_blocos} blocos em {time.perf_counter() - inicio:.2f}s.")
+    return resultados
 
-    # Adiciona valor total aos lotes adicionados/removidos
-    df_adicionados = pd.merge(df_adicionados_base, df_totais_atu, on=['Empreendimento', 'Lote', 'Cliente'], how='left')
-    df_removidos = pd.merge(df_removidos_base, df_totais_ant, on=['Empreendimento', 'Lote', 'Cliente'], how='left')
+def _consolidar_transicao(transicoes: list):
+    """Junta as partições de uma transição (mês anterior -> atual) nos DataFrames do relatório."""
+    df_comp = pd.concat([t['comp'] for t in transicoes], ignore_index=True)
+    df_adicionados = pd.concat([t['adicionados'] for t in transicoes], ignore_index=True)
+    df_removidos = pd.concat([t['removidos'] for t in transicoes], ignore_index=True)
 
     # Identifica divergências de valor, parcelas novas e removidas
     df_divergencias = df_comp[
@@ -587,13 +1268,15 @@ def processar_comparativo(texto_anterior, texto_atual, modo_separacao, emp_fixo_
     total_adicionados_valor = df_adicionados['Total Atual'].sum() if 'Total Atual' in df_adicionados.columns else 0
     total_removidos_valor = df_removidos['Total Anterior'].sum() if 'Total Anterior' in df_removidos.columns else 0
     total_divergencias_valor = df_divergencias['Diferença'].sum() if 'Diferença' in df_divergencias.columns else 0
-    total_mes_anterior_valor = df_totais_ant['Total Anterior'].sum() if 'Total Anterior' in df_totais_ant.columns else 0
-    total_mes_atual_valor = df_totais_atu['Total Atual'].sum() if 'Total Atual' in df_totais_atu.columns else 0
+    total_mes_anterior_valor = _somar_na_ordem_original([s for t in transicoes for s in t['totais_seq_ant']])
+    total_mes_atual_valor = _somar_na_ordem_original([s for t in transicoes for s in t['totais_seq_atu']])
 
     # Cria DataFrame de resumo
+    qtd_lotes_ant = sum(t['qtd_lotes_ant'] for t in transicoes)
+    qtd_lotes_atu = sum(t['qtd_lotes_atu'] for t in transicoes)
     resumo_financeiro_data = {
         ' ': ['Lotes Mês Anterior', 'Lotes Mês Atual', 'Lotes Adicionados', 'Lotes Removidos', 'Parcelas com Valor Alterado'],
-        'LOTES': [len(lotes_ant), len(lotes_atu), len(df_adicionados), len(df_removidos), df_divergencias['Lote'].nunique() if not df_divergencias.empty else 0],
+        'LOTES': [qtd_lotes_ant, qtd_lotes_atu, len(df_adicionados), len(df_removidos), df_divergencias['Lote'].nunique() if not df_divergencias.empty else 0],
         'TOTAIS': [total_mes_anterior_valor, total_mes_atual_valor, total_adicionados_valor, total_removidos_valor, total_divergencias_valor]
     }
     df_resumo_completo = pd.DataFrame(resumo_financeiro_data)
@@ -601,6 +1284,86 @@ def processar_comparativo(texto_anterior, texto_atual, modo_separacao, emp_fixo_
     # Retorna todos os DataFrames gerados
     return df_resumo_completo, df_adicionados, df_removidos, df_divergencias, df_parcelas_novas, df_parcelas_removidas
 
+def processar_comparativo(texto_anterior, texto_atual, modo_separacao, emp_fixo_boleto):
+    """Compara os dados extraídos de dois PDFs (a série de dois meses, sem a matriz de valores)."""
+    resultados = _executar_particoes([texto_anterior, texto_atual], modo_separacao, emp_fixo_boleto, com_matriz=False)
+    return _consolidar_transicao([r['transicoes'][0] for r in resultados])
+
+_PADRAO_PARTES_NOME = re.compile(r"(\d+)")
+
+def chave_nome_natural(nome: str) -> list:
+    """Ordena nomes de arquivo com os números pelo valor ('extrato_2' antes de 'extrato_10')."""
+    # re.split com grupo alterna texto e número, então as posições nunca comparam str com int
+    return [int(parte) if i % 2 else parte.lower() for i, parte in enumerate(_PADRAO_PARTES_NOME.split(os.path.basename(nome)))]
+
+def rotulos_meses(nomes_arquivos: list) -> list:
+    """Rótulo de cada mês na planilha: o nome do arquivo sem extensão, sem repetir nem colidir com as chaves."""
+    rotulos = []
+    for nome in nomes_arquivos:
+        base = os.path.splitext(os.path.basename(nome))[0] or 'Mês'
+        rotulo, n = base, 2
+        while rotulo in rotulos or rotulo in CHAVES_COMPARACAO:
+            rotulo, n = f"{base} ({n})", n + 1
+        rotulos.append(rotulo)
+    return rotulos
+
+def processar_comparativo_serie(textos: list, rotulos: list, modo_separacao: str, emp_fixo_boleto: str):
+    """Compara N meses numa passada. Retorna (planilhas do relatório, resumo de cada transição)."""
+    resultados = _executar_particoes(textos, modo_separacao, emp_fixo_boleto, com_matriz=True)
+
+    # Matriz de valores: uma coluna por mês, vazia onde a parcela não existe naquele mês
+    df_matriz = pd.DataFrame([linha for r in resultados for linha in r['matriz']], columns=CHAVES_COMPARACAO + rotulos)
+    df_matriz = df_matriz.astype({rotulo: 'float64' for rotulo in rotulos})
+    valores = df_matriz[rotulos]
+    variacao = valores.max(axis=1) - valores.min(axis=1)
+    df_alterados = df_matriz[variacao > 0.025].copy() # Mesma tolerância do comparativo entre dois meses
+    if not df_alterados.empty:
+        # Do primeiro ao último mês em que a parcela aparece
+        df_alterados['Diferença'] = valores.ffill(axis=1).iloc[:, -1] - valores.bfill(axis=1).iloc[:, 0]
+
+    linhas_resumo = [] # (rótulo, LOTES, TOTAIS) no formato da aba Resumo do comparativo simples
+    resumo_transicoes = []
+    adicionados, removidos, novas, removidas = [], [], [], []
+    for i in range(len(textos) - 1):
+        transicao = f"{rotulos[i]} → {rotulos[i + 1]}"
+        df_resumo, df_adicionados, df_removidos, df_divergencias, df_parcelas_novas, df_parcelas_removidas = \
+            _consolidar_transicao([r['transicoes'][i] for r in resultados])
+        resumo = dict(zip(df_resumo[' '], zip(df_resumo['LOTES'], df_resumo['TOTAIS'])))
+        if i == 0:
+            linhas_resumo.append((f"Lotes {rotulos[0]}",) + resumo['Lotes Mês Anterior'])
+        linhas_resumo.append((f"Lotes {rotulos[i + 1]}",) + resumo['Lotes Mês Atual'])
+        resumo_transicoes.append({
+            'transicao': transicao,
+            'lotes_adicionados': int(resumo['Lotes Adicionados'][0]),
+            'lotes_removidos': int(resumo['Lotes Removidos'][0]),
+            'total_adicionados': float(resumo['Lotes Adicionados'][1]),
+            'total_removidos': float(resumo['Lotes Removidos'][1]),
+            'parcelas_alteradas': int(resumo['Parcelas com Valor Alterado'][0]),
+            'total_diferencas': float(resumo['Parcelas com Valor Alterado'][1]),
+        })
+        for df, destino in ((df_adicionados, adicionados), (df_removidos, removidos),
+                            (df_parcelas_novas, novas), (df_parcelas_removidas, removidas)):
+            destino.append(df.assign(**{'Transição': transicao})[['Transição'] + list(df.columns)])
+
+    for t in resumo_transicoes:
+        linhas_resumo += [
+            (f"Lotes Adicionados {t['transicao']}", t['lotes_adicionados'], t['total_adicionados']),
+            (f"Lotes Removidos {t['transicao']}", t['lotes_removidos'], t['total_removidos']),
+            (f"Parcelas com Valor Alterado {t['transicao']}", t['parcelas_alteradas'], t['total_diferencas']),
+        ]
+    df_resumo_serie = pd.DataFrame(linhas_resumo, columns=[' ', 'LOTES', 'TOTAIS'])
+
+    planilhas = {
+        "Resumo": df_resumo_serie,
+        "Matriz de Valores": df_matriz,
+        "Valores Alterados": df_alterados,
+        "Lotes Adicionados": pd.concat(adicionados, ignore_index=True),
+        "Lotes Removidos": pd.concat(removidos, ignore_index=True),
+        "Parcelas Novas por Lote": pd.concat(novas, ignore_index=True),
+        "Parcelas Removidas por Lote": pd.concat(removidas, ignore_index=True),
+    }
+    return planilhas, resumo_transicoes
+
 
 def formatar_excel(output_stream, dfs: dict):
     """Formata planilhas de Validação e Comparação (não Repasse)."""
@@ -615,7 +1378,7 @@ def formatar_excel(output_stream, dfs: dict):
             if isinstance(df, pd.DataFrame):
                  df.to_excel(writer, index=False, sheet_name=sheet_name)
             else:
-                 print(f"[AVISO] Tentando salvar algo que não é DataFrame na planilha '{sheet_name}': {type(df)}")
+                 log.warning(f"Tentando salvar algo que não é DataFrame na planilha '{sheet_name}': {type(df)}")
                  pd.DataFrame([{"Erro": f"Dados inválidos para {sheet_name}"}]).to_excel(writer, index=False, sheet_name=sheet_name)
 
         number_style = NamedStyle(name='br_number_style', number_format='#,##0.00')
@@ -661,17 +1424,631 @@ def formatar_excel(output_stream, dfs: dict):
                     worksheet.column_dimensions[column].width = min(max(adjusted_width, 10), 60)
 
                 worksheet.auto_filter.ref = worksheet.dimensions
-                print(f"[LOG] Autofilter aplicado à planilha '{sheet_name}'. Ref: {worksheet.dimensions}")
+                log.debug("Autofilter aplicado à planilha '%s'. Ref: %s", sheet_name, worksheet.dimensions)
     return output_stream
 
 
+# ==== Relatórios sob demanda ====
+# Boa parte dos usuários só olha as divergências na tela. As rotas guardam as planilhas do relatório
+# (DataFrames em pickle) e já devolvem o link; o XLSX só é montado com openpyxl no primeiro /download
+# e fica em disco para os seguintes. Dados e planilhas dos relatórios mais antigos são descartados.
+# A montagem tem lock por relatório e passa pelo controle de admissão (custo pelo tamanho do pickle),
+# para que downloads simultâneos não ocupem todas as threads.
+# A revalidação da configuração gera um relatório por análise armazenada de uma vez, então esses
+# relatórios têm limite próprio e não empurram para fora os links das páginas de resultado.
+#   RELATORIOS_MAX             -> quantos relatórios de upload/comparação manter (padrão: 50)
+#   RELATORIOS_REVALIDACAO_MAX -> quantos relatórios de revalidação manter (padrão: ANALISES_MAX)
+RELATORIOS_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'relatorios')
+os.makedirs(RELATORIOS_FOLDER, exist_ok=True)
+RELATORIOS_MAX = int(os.environ.get('RELATORIOS_MAX', 50))
+RELATORIOS_REVALIDACAO_MAX = int(os.environ.get('RELATORIOS_REVALIDACAO_MAX', os.environ.get('ANALISES_MAX', 30)))
+PREFIXO_REVALIDACAO = 'revalidacao_' # nome_relatorio('revalidacao', ...) em revalidar_analises
+ADMISSAO_MB_POR_MB_RELATORIO = 8.0 # O openpyxl ocupa algumas vezes o tamanho dos DataFrames em pickle
+_relatorios_travas = {} # Nome do relatório -> [lock, quantos esperam por ele]
+_relatorios_travas_lock = threading.Lock()
+
+def nome_relatorio(*partes: str) -> str:
+    """Nome do XLSX: as partes, a data/hora e um sufixo aleatório (a data só vai até o segundo)."""
+    return f"{'_'.join(partes)}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.xlsx"
+
+def registrar_relatorio(report_filename: str, planilhas: dict):
+    """Guarda as planilhas (nome da aba -> DataFrame) para montar o XLSX no primeiro download."""
+    path = os.path.join(RELATORIOS_FOLDER, report_filename + '.pkl')
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        pd.to_pickle(planilhas, tmp)
+        try:
+            # Uma planilha já montada com o mesmo nome seria servida no lugar dos dados novos
+            os.remove(os.path.join(RELATORIOS_FOLDER, report_filename))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+        log.info(f"Relatório registrado para download: {report_filename}")
+        _descartar_relatorios_antigos()
+    except Exception as e:
+        log.error(f"[RELATORIOS] ERRO ao registrar '{report_filename}': {e}")
+
+def _descartar_relatorios_antigos():
+    """Mantém os relatórios mais recentes (dados pendentes ou planilha já montada), com um limite
+    para os de revalidação e outro para os demais."""
+    recentes = {}
+    for entrada in os.scandir(RELATORIOS_FOLDER):
+        if entrada.name.endswith('.xlsx.pkl'):
+            nome = entrada.name[:-len('.pkl')]
+        elif entrada.name.endswith('.xlsx'):
+            nome = entrada.name
+        else:
+            continue # Temporários em escrita
+        recentes[nome] = max(recentes.get(nome, 0), entrada.stat().st_mtime)
+    revalidacao = [nome for nome in recentes if nome.startswith(PREFIXO_REVALIDACAO)]
+    demais = [nome for nome in recentes if not nome.startswith(PREFIXO_REVALIDACAO)]
+    excedentes = (sorted(revalidacao, key=recentes.get, reverse=True)[RELATORIOS_REVALIDACAO_MAX:]
+                  + sorted(demais, key=recentes.get, reverse=True)[RELATORIOS_MAX:])
+    for nome in excedentes:
+        for path in (os.path.join(RELATORIOS_FOLDER, nome), os.path.join(RELATORIOS_FOLDER, nome + '.pkl')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+@contextmanager
+def _trava_relatorio(report_filename: str):
+    """Lock de um relatório: downloads de relatórios diferentes montam as planilhas em paralelo."""
+    with _relatorios_travas_lock:
+        trava = _relatorios_travas.setdefault(report_filename, [threading.Lock(), 0])
+        trava[1] += 1
+    try:
+        with trava[0]:
+            yield
+    finally:
+        with _relatorios_travas_lock:
+            trava[1] -= 1
+            if not trava[1]:
+                del _relatorios_travas[report_filename]
+
+def custo_montagem_relatorio(report_filename: str):
+    """Memória estimada (MB) para montar o XLSX, pelo tamanho dos dados guardados. None se já está montado ou expirou."""
+    path = os.path.join(RELATORIOS_FOLDER, report_filename)
+    if os.path.exists(path):
+        return None
+    try:
+        tamanho_mb = os.path.getsize(path + '.pkl') / (1024 * 1024)
+    except FileNotFoundError:
+        return None
+    return ADMISSAO_MB_BASE + tamanho_mb * ADMISSAO_MB_POR_MB_RELATORIO
+
+def montar_relatorio(report_filename: str):
+    """Caminho do XLSX, montado na primeira chamada a partir dos dados guardados. None se expirou."""
+    path = os.path.join(RELATORIOS_FOLDER, report_filename)
+    if os.path.exists(path):
+        return path
+    with _trava_relatorio(report_filename): # Dois downloads simultâneos do mesmo relatório montam a planilha uma vez
+        if os.path.exists(path):
+            return path
+        try:
+            planilhas = pd.read_pickle(path + '.pkl')
+        except FileNotFoundError:
+            return None
+        inicio = time.perf_counter()
+        output = io.BytesIO()
+        formatar_excel(output, planilhas)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(output.getvalue())
+        os.replace(tmp, path)
+        try:
+            os.remove(path + '.pkl') # A planilha montada passa a ser o cache
+        except FileNotFoundError:
+            pass # Outro worker do gunicorn montou ao mesmo tempo
+        log.info(f"Relatório montado no primeiro download em {time.perf_counter() - inicio:.2f}s: {report_filename}")
+    return path
+
+def registrar_relatorio_validacao(df_todas_raw, df_cov, df_div, report_filename: str):
+    """Filtra as parcelas de resumo da aba completa e registra o relatório de validação."""
+    df_todas_filtrado = df_todas_raw.copy()
+    if not df_todas_filtrado.empty:
+        parcelas_para_remover = ['TOTAL A PAGAR', 'DESCONTO', 'DÉBITOS DO MÊS ANTERIOR', 'ENCARGOS POR ATRASO', 'PAGAMENTO EFETUADO', 'DÉBITOS DO MÊS']
+        df_todas_filtrado = df_todas_filtrado[~df_todas_filtrado['Parcela'].astype(str).str.strip().str.upper().isin(parcelas_para_remover)]
+        df_todas_filtrado = df_todas_filtrado[~df_todas_filtrado['Parcela'].astype(str).str.strip().str.upper().str.startswith('TOTAL BANCO')]
+    log.debug("Parcelas indesejadas filtradas da aba 'Todas_Parcelas_Extraidas'.")
+    registrar_relatorio(report_filename, {"Divergencias": df_div, "Cobertura_Analise": df_cov, "Todas_Parcelas_Extraidas": df_todas_filtrado})
+
+
+# ==== Análises armazenadas (revalidação sem reler o PDF) ====
+# Cada upload de validação guarda os lotes parseados em uploads/analises/<id>.json.
+# Assim, após mudar a configuração, basta reaplicar validar_lotes() sobre eles.
+#   ANALISES_MAX -> quantas análises recentes manter (padrão: 30)
+ANALISES_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'analises')
+os.makedirs(ANALISES_FOLDER, exist_ok=True)
+ANALISES_MAX = int(os.environ.get('ANALISES_MAX', 30))
+
+def salvar_analise(arquivo: str, modo_separacao: str, emp_fixo: str, lotes: list, total_divergencias: int) -> str:
+    """Grava os lotes parseados de um upload e descarta as análises mais antigas. Retorna o id."""
+    analise_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    registro = {
+        'id': analise_id, 'arquivo': arquivo, 'modo': modo_separacao, 'emp_fixo': emp_fixo,
+        'data': datetime.now().strftime('%d/%m/%Y %H:%M'),
+        'total_divergencias': total_divergencias, 'lotes': lotes,
+    }
+    path = os.path.join(ANALISES_FOLDER, f"{analise_id}.json")
+    try:
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(registro, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        for antigo in _listar_arquivos_analises()[ANALISES_MAX:]:
+            os.remove(os.path.join(ANALISES_FOLDER, antigo))
+    except Exception as e:
+        log.error(f"[ANALISES] ERRO ao salvar análise de '{arquivo}': {e}")
+    return analise_id
+
+def _listar_arquivos_analises() -> list:
+    """Nomes dos arquivos de análise, do mais recente para o mais antigo."""
+    return sorted((n for n in os.listdir(ANALISES_FOLDER) if n.endswith('.json')), reverse=True)
+
+def carregar_analises(limite: int = None) -> list:
+    analises = []
+    for nome in _listar_arquivos_analises()[:limite]:
+        try:
+            with open(os.path.join(ANALISES_FOLDER, nome), 'r', encoding='utf-8') as f:
+                analises.append(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning(f"[ANALISES] Ignorando '{nome}': {e}")
+    return analises
+
+def revalidar_analises(cfg: dict, analises: list = None, gerar_relatorios: bool = True) -> list:
+    """Reaplica a validação às análises recentes com `cfg`, sem reextrair os PDFs."""
+    if analises is None:
+        analises = carregar_analises()
+    resultados = []
+    for analise in analises:
+        df_todas_raw, df_cov, df_div = validar_lotes(analise['lotes'], analise['modo'], cfg)
+        resultado = {
+            'id': analise['id'], 'arquivo': analise['arquivo'], 'data': analise['data'],
+            'modo': analise['modo'].replace('_', '/').upper(), 'total_lotes': len(df_cov),
+            'divergencias_antes': analise.get('total_divergencias', 0),
+            'divergencias_depois': len(df_div),
+        }
+        if gerar_relatorios:
+            base_name = os.path.splitext(analise['arquivo'])[0]
+            # O id da análise separa os relatórios de uploads diferentes do mesmo extrato
+            report_filename = nome_relatorio('revalidacao', analise['modo'], base_name, analise['id'])
+            registrar_relatorio_validacao(df_todas_raw, df_cov, df_div, report_filename)
+            resultado['download_url'] = url_for('download_file', filename=report_filename)
+        resultados.append(resultado)
+    return resultados
+
+
+# ==== Validação progressiva (Server-Sent Events) ====
+# O formulário de validação grava o PDF como um "job" em uploads/jobs e redireciona para a
+# página de resultados, que abre um EventSource. O processamento acontece dentro da própria
+# requisição do stream, então funciona com vários workers do gunicorn (o job está em disco).
+JOBS_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'jobs')
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+JOBS_VALIDADE_S = 3600 # Jobs não abertos em 1h são descartados
+PADRAO_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+COLUNAS_DIVERGENCIAS = ["Empreendimento", "Lote", "Cliente", "Parcela", "Valor no Documento", "Valor Correto"]
+
+def criar_job(pdf_bytes: bytes, arquivo: str, modo_separacao: str, emp_fixo: str) -> str:
+    _limpar_jobs_antigos()
+    job_id = uuid.uuid4().hex
+    with open(os.path.join(JOBS_FOLDER, f"{job_id}.pdf"), 'wb') as f:
+        f.write(pdf_bytes)
+    with open(os.path.join(JOBS_FOLDER, f"{job_id}.json"), 'w', encoding='utf-8') as f:
+        json.dump({'arquivo': arquivo, 'modo': modo_separacao, 'emp_fixo': emp_fixo}, f, ensure_ascii=False)
+    return job_id
+
+def carregar_job(job_id: str):
+    """Retorna (metadados, bytes do PDF) ou None se o job não existir."""
+    if not PADRAO_JOB_ID.match(job_id or ''):
+        return None
+    try:
+        with open(os.path.join(JOBS_FOLDER, f"{job_id}.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(os.path.join(JOBS_FOLDER, f"{job_id}.pdf"), 'rb') as f:
+            return meta, f.read()
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def remover_job(job_id: str):
+    for ext in ('.pdf', '.json'):
+        try:
+            os.remove(os.path.join(JOBS_FOLDER, job_id + ext))
+        except OSError:
+            pass
+
+def _limpar_jobs_antigos():
+    limite = time.time() - JOBS_VALIDADE_S
+    for nome in os.listdir(JOBS_FOLDER):
+        path = os.path.join(JOBS_FOLDER, nome)
+        try:
+            if os.path.getmtime(path) < limite:
+                os.remove(path)
+        except OSError:
+            pass
+
+def processar_validacao_progressiva(pdf_bytes: bytes, arquivo: str, modo_separacao: str, emp_fixo: str):
+    """Mesmo resultado da rota /upload, gerando eventos (nome, dados) à medida que o trabalho avança.
+
+    Os blocos são parseados e validados assim que a página seguinte fecha o lote, então as
+    primeiras divergências saem antes do fim da extração; o progresso é enviado a cada página.
+    """
+    cfg = carregar_config()
+    progresso = {'paginas': 0, 'total_paginas': 0, 'nao_classificados': 0}
+
+    def paginas():
+        for indice, total, texto_pagina in extrair_paginas(pdf_bytes):
+            progresso['paginas'], progresso['total_paginas'] = indice + 1, total
+            yield texto_pagina + "\n" # Adiciona nova linha entre páginas
+
+    lotes, linhas_todas, linhas_cov, linhas_div = [], [], [], []
+    for blocos in fatiar_blocos_incremental(paginas()):
+        pendentes = []
+        for lote, bloco in blocos:
+            registro = parsear_bloco(lote, bloco, modo_separacao, emp_fixo)
+            todas, cov, div = validar_lote(registro, modo_separacao, cfg)
+            lotes.append(registro)
+            linhas_todas.extend(todas)
+            linhas_cov.append(cov)
+            linhas_div.extend(div)
+            pendentes.extend(div)
+            if registro['Empreendimento'] == 'NAO_CLASSIFICADO':
+                progresso['nao_classificados'] += 1
+        yield from _eventos_progresso(progresso, lotes, linhas_div, pendentes)
+
+    if not progresso['total_paginas']:
+        raise ValueError("Não foi possível extrair o texto do arquivo enviado. Ele pode estar corrompido, ser uma imagem ou estar vazio.")
+
+    yield 'etapa', {'mensagem': 'Finalizando a análise...'}
+    df_todas_raw, df_cov, df_div = pd.DataFrame(linhas_todas), pd.DataFrame(linhas_cov), pd.DataFrame(linhas_div)
+    log.info(f"Validação concluída. {len(df_cov)} lotes/registros encontrados, {len(df_div)} divergências.")
+    base_name = os.path.splitext(arquivo)[0]
+    report_filename = nome_relatorio('relatorio', modo_separacao, base_name)
+    registrar_relatorio_validacao(df_todas_raw, df_cov, df_div, report_filename)
+    salvar_analise(arquivo, modo_separacao, emp_fixo, lotes, len(df_div))
+
+    yield 'concluido', {
+        'total_lotes': len(df_cov), 'total_divergencias': len(df_div),
+        'nao_classificados': progresso['nao_classificados'],
+        'download_url': url_for('download_file', filename=report_filename),
+    }
+
+def _eventos_progresso(progresso: dict, lotes: list, linhas_div: list, pendentes: list):
+    yield 'progresso', {
+        'paginas': progresso['paginas'], 'total_paginas': progresso['total_paginas'],
+        'lotes': len(lotes), 'divergencias': len(linhas_div),
+        'nao_classificados': progresso['nao_classificados'],
+    }
+    if pendentes:
+        yield 'divergencias', {'columns': COLUNAS_DIVERGENCIAS, 'data': [[d[c] for c in COLUNAS_DIVERGENCIAS] for d in pendentes]}
+
+def formatar_evento_sse(evento: str, dados: dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+
+# ==== Controle de admissão (backpressure nas rotas pesadas) ====
+# Cada worker do gunicorn tem o seu próprio controlador; o orçamento vale por processo.
+# Quem espera na fila segura uma thread do gthread: rotas pesadas (estimando o custo, na fila ou
+# rodando) nunca ocupam todas as threads, para que '/', '/download' e '/status' continuem respondendo.
+# A thread é reservada antes da estimativa, que conta as páginas no processo de extração.
+#   GUNICORN_THREADS        -> threads por worker, o mesmo --threads do Dockerfile (padrão: 4)
+#   ADMISSAO_ORCAMENTO_MB   -> memória estimada máxima em processamento simultâneo (padrão: 768)
+#   ADMISSAO_FILA_MAX       -> requisições que podem aguardar na fila (padrão: GUNICORN_THREADS - 2)
+#   ADMISSAO_ESPERA_S       -> tempo máximo de espera na fila antes do 503 (padrão: 60)
+#   ADMISSAO_RETRY_AFTER_S  -> valor do cabeçalho Retry-After no 503 (padrão: 30)
+GUNICORN_THREADS       = int(os.environ.get('GUNICORN_THREADS', 4))
+ADMISSAO_MAX_THREADS   = max(1, GUNICORN_THREADS - 1) # Pelo menos uma thread fica livre para as rotas leves
+ADMISSAO_ORCAMENTO_MB  = float(os.environ.get('ADMISSAO_ORCAMENTO_MB', 768))
+ADMISSAO_FILA_MAX      = int(os.environ.get('ADMISSAO_FILA_MAX', max(0, GUNICORN_THREADS - 2)))
+ADMISSAO_ESPERA_S      = float(os.environ.get('ADMISSAO_ESPERA_S', 60))
+ADMISSAO_RETRY_AFTER_S = int(os.environ.get('ADMISSAO_RETRY_AFTER_S', 30))
+# Fatores da estimativa de custo (medidos em extratos reais com PyMuPDF + pandas + openpyxl)
+ADMISSAO_MB_BASE       = 16.0  # custo fixo de uma requisição
+ADMISSAO_MB_POR_MB_PDF = 4.0   # o documento aberto ocupa algumas vezes o tamanho do arquivo
+ADMISSAO_MB_POR_PAGINA = 1.5   # texto extraído, DataFrames e planilha crescem com as páginas
+
+@contextmanager
+def conteudo_sem_copia(stream):
+    """Conteúdo do PDF (bytes ou stream do upload) como memoryview, sem ler o arquivo para a memória."""
+    if isinstance(stream, (bytes, bytearray)):
+        yield memoryview(stream)
+        return
+    if isinstance(stream, io.BytesIO):
+        visao = stream.getbuffer()
+        try:
+            yield visao
+        finally:
+            visao.release()
+        return
+    # Upload grande: o werkzeug grava num arquivo temporário, lido por mmap direto do page cache
+    stream.seek(0, os.SEEK_END)
+    if stream.tell() == 0:
+        stream.seek(0)
+        yield memoryview(b"")
+        return
+    stream.seek(0)
+    mapa = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    visao = memoryview(mapa)
+    try:
+        yield visao
+    finally:
+        visao.release()
+        mapa.close()
+
+def estimar_custo_pdf(conteudo) -> float:
+    """Estima a memória (MB) que o processamento de um PDF vai exigir, sem extrair o texto.
+
+    Com a extração isolada, até o fitz.open (que pode reparar a xref por minutos) roda no processo
+    filho; se ele estourar prazo ou limites, levanta ErroExtracaoPdf antes de a rota começar.
+    """
+    paginas = 0
+    try:
+        if EXTRACAO_ISOLADA:
+            paginas = EXTRATOR_PDF.contar_paginas(conteudo) if len(conteudo) else 0
+        else:
+            with fitz.open(stream=conteudo, filetype="pdf") as doc:
+                paginas = doc.page_count
+    except ErroExtracaoPdf:
+        raise
+    except Exception as e:
+        # PDF inválido: a rota vai falhar rápido na extração, conta só o tamanho
+        log.warning(f"[ADMISSAO] Não foi possível contar as páginas: {type(e).__name__} - {e}")
+    tamanho_mb = len(conteudo) / (1024 * 1024)
+    return tamanho_mb * ADMISSAO_MB_POR_MB_PDF + paginas * ADMISSAO_MB_POR_PAGINA
+
+def estimar_custo_requisicao(arquivos) -> float:
+    """Soma o custo estimado de todos os PDFs enviados na requisição."""
+    custo = ADMISSAO_MB_BASE
+    for _, arquivo in arquivos.items(multi=True): # A série de meses envia vários arquivos no mesmo campo
+        if not arquivo or not arquivo.filename:
+            continue
+        # O PDF fica onde o werkzeug o guardou: quem é rejeitado ou espera na fila não o carrega
+        with conteudo_sem_copia(arquivo.stream) as conteudo:
+            custo += estimar_custo_pdf(conteudo)
+    return custo
+
+class ControleAdmissao:
+    """Limita a memória estimada em processamento simultâneo, com fila FIFO limitada."""
+
+    def __init__(self, orcamento_mb: float, fila_max: int, espera_max_s: float, max_threads: int):
+        self.orcamento_mb = orcamento_mb
+        self.fila_max = fila_max
+        self.max_threads = max_threads # Requisições pesadas com thread ocupada: estimando, na fila ou rodando
+        self.espera_max_s = espera_max_s
+        self._cond = threading.Condition()
+        self._fila = deque()
+        self._em_uso_mb = 0.0
+        self._em_execucao = 0
+        self._threads_ocupadas = 0
+        self._admitidas = 0
+        self._rejeitadas_fila_cheia = 0
+        self._rejeitadas_sem_thread = 0
+        self._rejeitadas_tempo_esgotado = 0
+
+    def _cabe(self, custo_mb: float) -> bool:
+        # Uma requisição maior que o orçamento inteiro roda sozinha, em vez de nunca rodar
+        return self._em_execucao == 0 or self._em_uso_mb + custo_mb <= self.orcamento_mb
+
+    def ocupar_thread(self) -> bool:
+        """Primeiro passo de toda rota pesada, antes até de estimar o custo (que pode esperar pela
+        extração). Retorna False se a requisição deve receber 503 para não tomar a última thread."""
+        with self._cond:
+            if self._threads_ocupadas >= self.max_threads:
+                self._rejeitadas_sem_thread += 1
+                log.warning(f"[ADMISSAO] Rejeitada (sem thread livre). {self._em_execucao} em execução, {len(self._fila)} na fila, "
+                            f"{self._threads_ocupadas} thread(s) ocupada(s).")
+                return False
+            self._threads_ocupadas += 1
+            return True
+
+    def liberar_thread(self):
+        with self._cond:
+            self._threads_ocupadas -= 1
+
+    def adquirir(self, custo_mb: float) -> bool:
+        """Reserva `custo_mb` do orçamento (com a thread já ocupada). Retorna False se a requisição deve receber 503."""
+        with self._cond:
+            if not self._fila and self._cabe(custo_mb):
+                self._reservar(custo_mb)
+                return True
+            if len(self._fila) >= self.fila_max:
+                self._rejeitadas_fila_cheia += 1
+                log.warning(f"[ADMISSAO] Rejeitada (fila cheia). Custo {custo_mb:.0f} MB, em uso {self._em_uso_mb:.0f}/{self.orcamento_mb:.0f} MB.")
+                return False
+
+            senha = object()
+            self._fila.append(senha)
+            limite = time.monotonic() + self.espera_max_s
+            try:
+                while not (self._fila[0] is senha and self._cabe(custo_mb)):
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._rejeitadas_tempo_esgotado += 1
+                        log.warning(f"[ADMISSAO] Rejeitada (tempo de espera esgotado). Custo {custo_mb:.0f} MB.")
+                        return False
+                    self._cond.wait(restante)
+                self._reservar(custo_mb)
+                return True
+            finally:
+                self._fila.remove(senha)
+                # O próximo da fila pode caber agora (ou este saiu sem reservar)
+                self._cond.notify_all()
+
+    def _reservar(self, custo_mb: float):
+        self._em_uso_mb += custo_mb
+        self._em_execucao += 1
+        self._admitidas += 1
+
+    def liberar(self, custo_mb: float):
+        with self._cond:
+            self._em_uso_mb = max(0.0, self._em_uso_mb - custo_mb)
+            self._em_execucao -= 1
+            self._cond.notify_all()
+
+    def estatisticas(self) -> dict:
+        with self._cond:
+            return {
+                'orcamento_mb': self.orcamento_mb,
+                'em_uso_mb': round(self._em_uso_mb, 1),
+                'em_execucao': self._em_execucao,
+                'fila': len(self._fila),
+                'fila_max': self.fila_max,
+                'max_threads': self.max_threads,
+                'threads_ocupadas': self._threads_ocupadas,
+                'admitidas': self._admitidas,
+                'rejeitadas_fila_cheia': self._rejeitadas_fila_cheia,
+                'rejeitadas_sem_thread': self._rejeitadas_sem_thread,
+                'rejeitadas_tempo_esgotado': self._rejeitadas_tempo_esgotado,
+            }
+
+CONTROLE_ADMISSAO = ControleAdmissao(ADMISSAO_ORCAMENTO_MB, ADMISSAO_FILA_MAX, ADMISSAO_ESPERA_S, ADMISSAO_MAX_THREADS)
+
+def resposta_sobrecarga():
+    resp = make_response(manual_render_template('error.html', status_code=503,
+        error_title="Servidor ocupado",
+        error_message=(f"Há muitos arquivos grandes em processamento no momento. "
+                       f"Aguarde cerca de {ADMISSAO_RETRY_AFTER_S} segundos e envie novamente.")))
+    resp.headers['Retry-After'] = str(ADMISSAO_RETRY_AFTER_S)
+    return resp
+
+def admissao_controlada(view):
+    """Decorator das rotas pesadas: reserva o custo estimado antes de processar."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not CONTROLE_ADMISSAO.ocupar_thread():
+            return resposta_sobrecarga()
+        try:
+            try:
+                custo = estimar_custo_requisicao(request.files)
+            except ErroExtracaoPdf as e:
+                log.warning(f"Extração falhou ao estimar o custo da requisição: {e}")
+                return manual_render_template('error.html', status_code=422,
+                    error_title="Erro ao ler o PDF", error_message=str(e))
+            if not CONTROLE_ADMISSAO.adquirir(custo):
+                return resposta_sobrecarga()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                CONTROLE_ADMISSAO.liberar(custo)
+        finally:
+            CONTROLE_ADMISSAO.liberar_thread()
+    return wrapper
+
+
+# ==== Compressão e cache condicional das respostas ====
+#   COMPRESSAO_MIN_BYTES -> tamanho mínimo do corpo para comprimir (padrão: 1024)
+# Brotli é usado se o pacote `brotli` estiver instalado e o navegador aceitar; senão, gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSAO_MIN_BYTES = int(os.environ.get('COMPRESSAO_MIN_BYTES', 1024))
+COMPRESSAO_TIPOS = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+COMPRESSAO_CACHE_MAX_BYTES = 8 * 1024 * 1024
+# Páginas que só mudam com o template ou a configuração: recebem ETag e respondem 304.
+# Só elas passam pelo cache de compressão: as páginas de resultado são respostas únicas de POST
+# (cada uma é comprimida uma única vez, na hora de sair) e nunca seriam reaproveitadas.
+ROTAS_COM_ETAG = {'/', '/configuracoes'}
+
+_cache_compressao = OrderedDict() # (ETag sem codificação, codificação) -> corpo comprimido, em ordem LRU
+_cache_compressao_bytes = 0
+_cache_compressao_lock = threading.Lock()
+
+def _escolher_codificacao(accept_encoding) -> str:
+    if brotli is not None and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return None
+
+def comprimir_corpo(corpo: bytes, codificacao: str, etag: str = None) -> bytes:
+    """Comprime o corpo. Com `etag`, reaproveita o resultado se o mesmo conteúdo já foi comprimido."""
+    global _cache_compressao_bytes
+    chave = (etag, codificacao)
+    if etag is not None:
+        with _cache_compressao_lock:
+            comprimido = _cache_compressao.get(chave)
+            if comprimido is not None:
+                _cache_compressao.move_to_end(chave)
+                return comprimido
+
+    if codificacao == 'br':
+        comprimido = brotli.compress(corpo, quality=5)
+    else:
+        comprimido = gzip.compress(corpo, compresslevel=6, mtime=0)
+    if etag is None:
+        return comprimido
+
+    with _cache_compressao_lock:
+        if chave not in _cache_compressao and len(comprimido) <= COMPRESSAO_CACHE_MAX_BYTES:
+            _cache_compressao[chave] = comprimido
+            _cache_compressao_bytes += len(comprimido)
+            while _cache_compressao_bytes > COMPRESSAO_CACHE_MAX_BYTES:
+                _, antigo = _cache_compressao.popitem(last=False)
+                _cache_compressao_bytes -= len(antigo)
+    return comprimido
+
+@app.before_request
+def definir_id_correlacao():
+    # Aceita o id do proxy (Render envia X-Request-ID) para cruzar com os logs de acesso
+    ID_CORRELACAO.set(request.headers.get('X-Request-ID', '')[:36] or uuid.uuid4().hex[:8])
+
+@app.after_request
+def comprimir_e_validar_cache(response):
+    response.headers.setdefault('X-Request-ID', ID_CORRELACAO.get())
+    # Downloads (send_file) e o stream de progresso passam direto
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or response.mimetype not in COMPRESSAO_TIPOS or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    corpo = response.get_data()
+    codificacao = _escolher_codificacao(request.accept_encodings) if len(corpo) >= COMPRESSAO_MIN_BYTES else None
+
+    etag = None
+    if request.method == 'GET' and request.path in ROTAS_COM_ETAG:
+        # Cada representação (identidade, gzip, br) tem a sua ETag
+        etag = hashlib.sha1(corpo).hexdigest()
+        response.set_etag(f"{etag}-{codificacao}" if codificacao else etag)
+        response.headers['Cache-Control'] = 'private, no-cache' # Sempre revalida, mas aproveita o 304
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if codificacao:
+        response.set_data(comprimir_corpo(corpo, codificacao, etag))
+        response.headers['Content-Encoding'] = codificacao
+    return response
+
+
 # ==== ROTAS FLASK ====
 
 @app.route('/')
 def index():
     return manual_render_template('index.html')
 
+def _checar_envio_validacao(file, modo_separacao: str):
+    """Confere nome do arquivo x modo. Retorna (emp_fixo, resposta de erro ou None)."""
+    emp_fixo = None
+    if modo_separacao == 'boleto':
+        emp_fixo = detectar_emp_por_nome_arquivo(file.filename)
+        if not emp_fixo:
+            error_msg = ("Para o modo 'Boleto', o nome do arquivo precisa terminar com um código de empreendimento válido (ex: 'Extrato_RSCI.pdf'). "
+                         "Verifique o nome do arquivo ou selecione outro modo de análise.")
+            return None, manual_render_template('error.html', status_code=400,
+                error_title="Empreendimento não identificado (Modo Boleto)", error_message=error_msg)
+
+    elif modo_separacao in ['debito_credito', 'ccb_realiza']:
+         if detectar_emp_por_nome_arquivo(file.filename) and modo_separacao == 'debito_credito':
+              error_msg = ("Este arquivo parece ser do tipo 'Boleto' (termina com código de empreendimento), mas o modo 'Débito/Crédito' foi selecionado. "
+                           "Por favor, use o modo 'Boleto' ou renomeie o arquivo se ele não for específico de um empreendimento.")
+              return None, manual_render_template('error.html', status_code=400,
+                                                  error_title="Modo de Análise Incorreto?", error_message=error_msg)
+    return emp_fixo, None
+
 @app.route('/upload', methods=['POST'])
+@admissao_controlada
 def upload_file():
     if 'pdf_file' not in request.files or request.files['pdf_file'].filename == '':
         return manual_render_template('error.html', status_code=400,
@@ -682,65 +2059,35 @@ def upload_file():
     modo_separacao = request.form.get('modo_separacao', 'boleto')
 
     try:
-        emp_fixo = None
-        if modo_separacao == 'boleto':
-            emp_fixo = detectar_emp_por_nome_arquivo(file.filename)
-            if not emp_fixo:
-                error_msg = ("Para o modo 'Boleto', o nome do arquivo precisa terminar com um código de empreendimento válido (ex: 'Extrato_RSCI.pdf'). "
-                             "Verifique o nome do arquivo ou selecione outro modo de análise.")
-                return manual_render_template('error.html', status_code=400,
-                    error_title="Empreendimento não identificado (Modo Boleto)", error_message=error_msg)
+        emp_fixo, erro = _checar_envio_validacao(file, modo_separacao)
+        if erro:
+            return erro
 
-        elif modo_separacao in ['debito_credito', 'ccb_realiza']:
-             if detectar_emp_por_nome_arquivo(file.filename) and modo_separacao == 'debito_credito':
-                  error_msg = ("Este arquivo parece ser do tipo 'Boleto' (termina com código de empreendimento), mas o modo 'Débito/Crédito' foi selecionado. "
-                               "Por favor, use o modo 'Boleto' ou renomeie o arquivo se ele não for específico de um empreendimento.")
-                  return manual_render_template('error.html', status_code=400,
-                                                error_title="Modo de Análise Incorreto?", error_message=error_msg)
-
-        print(f"Iniciando validação para o arquivo '{file.filename}' no modo '{modo_separacao}'...")
+        log.info(f"Iniciando validação para o arquivo '{file.filename}' no modo '{modo_separacao}'...")
         pdf_stream = file.read()
         texto_pdf = extrair_texto_pdf(pdf_stream)
         if not texto_pdf:
-            print(f"Falha ao extrair texto do PDF: {file.filename}")
+            log.error(f"Falha ao extrair texto do PDF: {file.filename}")
             return manual_render_template('error.html', status_code=500,
                 error_title="Erro ao ler o PDF",
                 error_message="Não foi possível extrair o texto do arquivo enviado. Ele pode estar corrompido, ser uma imagem ou estar vazio.")
 
-        print("Texto extraído, processando validação...")
-        df_todas_raw, df_cov, df_div = processar_pdf_validacao(texto_pdf, modo_separacao, emp_fixo)
-        print(f"Validação concluída. {len(df_cov)} lotes/registros encontrados, {len(df_div)} divergências.")
-
-        df_todas_filtrado = df_todas_raw.copy()
-        if not df_todas_filtrado.empty:
-            parcelas_para_remover = ['TOTAL A PAGAR', 'DESCONTO', 'DÉBITOS DO MÊS ANTERIOR', 'ENCARGOS POR ATRASO', 'PAGAMENTO EFETUADO', 'DÉBITOS DO MÊS']
-            df_todas_filtrado = df_todas_filtrado[~df_todas_filtrado['Parcela'].astype(str).str.strip().str.upper().isin(parcelas_para_remover)]
-            df_todas_filtrado = df_todas_filtrado[~df_todas_filtrado['Parcela'].astype(str).str.strip().str.upper().str.startswith('TOTAL BANCO')]
-        print("Parcelas indesejadas filtradas da aba 'Todas_Parcelas_Extraidas'.")
-
-        output = io.BytesIO()
-        dfs_to_excel = {"Divergencias": df_div, "Cobertura_Analise": df_cov, "Todas_Parcelas_Extraidas": df_todas_filtrado}
-        print("Gerando arquivo Excel...")
-        formatar_excel(output, dfs_to_excel) # Chama a função formatar_excel com autofiltro
-        output.seek(0)
-        print("Arquivo Excel gerado em memória.")
+        log.debug("Texto extraído, processando validação...")
+        lotes = parsear_lotes(texto_pdf, modo_separacao, emp_fixo)
+        df_todas_raw, df_cov, df_div = validar_lotes(lotes, modo_separacao)
+        log.info(f"Validação concluída. {len(df_cov)} lotes/registros encontrados, {len(df_div)} divergências.")
 
         base_name = os.path.splitext(file.filename)[0]
-        report_filename = f"relatorio_{modo_separacao}_{base_name}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        report_path = os.path.join(app.config['UPLOAD_FOLDER'], report_filename)
-
-        try:
-            with open(report_path, 'wb') as f: f.write(output.getvalue())
-            print(f"Relatório salvo em: {report_path}")
-        except Exception as e_save:
-            print(f"Erro ao salvar o arquivo Excel em {report_path}: {e_save}")
+        report_filename = nome_relatorio('relatorio', modo_separacao, base_name)
+        registrar_relatorio_validacao(df_todas_raw, df_cov, df_div, report_filename)
+        salvar_analise(file.filename, modo_separacao, emp_fixo, lotes, len(df_div))
 
         nao_classificados = 0
         if not df_cov.empty and 'Empreendimento' in df_cov.columns:
             nao_classificados = df_cov[df_cov['Empreendimento'] == 'NAO_CLASSIFICADO'].shape[0]
-            if nao_classificados > 0: print(f"[AVISO] {nao_classificados} registros não classificados.")
+            if nao_classificados > 0: log.warning(f"{nao_classificados} registros não classificados.")
 
-        print("Renderizando página de resultados...")
+        log.debug("Renderizando página de resultados...")
         return manual_render_template('results.html',
             divergencias_json=df_div.to_json(orient='split', index=False, date_format='iso') if not df_div.empty else 'null',
             total_lotes=len(df_cov),
@@ -750,14 +2097,103 @@ def upload_file():
             modo_usado=modo_separacao.replace('_', '/').upper()
         )
 
+    except ErroExtracaoPdf as e:
+        log.warning(f"Extração falhou para '{file.filename}': {e}")
+        return manual_render_template('error.html', status_code=422,
+            error_title="Erro ao ler o PDF", error_message=str(e))
     except Exception as e:
-        print(f"📕 [ERRO FATAL] Erro inesperado na rota /upload: {e}")
-        traceback.print_exc()
+        log.exception(f"Erro inesperado na rota /upload: {e}")
         return manual_render_template('error.html', status_code=500,
             error_title="Erro inesperado no processamento",
             error_message=f"Ocorreu um erro grave durante a análise do arquivo '{file.filename}'. Detalhes: {e}")
 
+@app.route('/upload/iniciar', methods=['POST'])
+def upload_iniciar():
+    """Grava o PDF como job e abre a página de resultados progressivos."""
+    if 'pdf_file' not in request.files or request.files['pdf_file'].filename == '':
+        return manual_render_template('error.html', status_code=400,
+            error_title="Nenhum arquivo enviado",
+            error_message="Você precisa selecionar um arquivo PDF para fazer a análise.")
+
+    file = request.files['pdf_file']
+    modo_separacao = request.form.get('modo_separacao', 'boleto')
+    emp_fixo, erro = _checar_envio_validacao(file, modo_separacao)
+    if erro:
+        return erro
+
+    job_id = criar_job(file.read(), file.filename, modo_separacao, emp_fixo)
+    log.info(f"Job {job_id[:8]} criado para o arquivo '{file.filename}' no modo '{modo_separacao}'.")
+    return redirect(url_for('resultados_progressivos', job_id=job_id))
+
+@app.route('/resultados/<job_id>')
+def resultados_progressivos(job_id):
+    job = carregar_job(job_id)
+    if job is None:
+        return manual_render_template('error.html', status_code=404,
+            error_title="Análise não encontrada",
+            error_message="Esta análise já foi concluída ou expirou. Envie o arquivo novamente.")
+    meta, _ = job
+    return manual_render_template('results_stream.html',
+        stream_url=url_for('upload_progresso', job_id=job_id),
+        arquivo=html.escape(meta['arquivo']),
+        modo_usado=meta['modo'].replace('_', '/').upper())
+
+@app.route('/upload/progresso/<job_id>')
+def upload_progresso(job_id):
+    """Processa o job e envia o progresso como Server-Sent Events."""
+    job = carregar_job(job_id)
+    if job is None:
+        # Evita que o EventSource fique reconectando num job já concluído
+        return Response(formatar_evento_sse('erro', {'titulo': "Análise não encontrada",
+            'mensagem': "Esta análise já foi concluída ou expirou. Envie o arquivo novamente."}), mimetype='text/event-stream')
+    meta, pdf_bytes = job
+
+    # A thread fica ocupada até o fim do stream: reservada antes da estimativa, liberada no fechamento
+    if not CONTROLE_ADMISSAO.ocupar_thread():
+        return resposta_sobrecarga()
+    try:
+        custo = ADMISSAO_MB_BASE + estimar_custo_pdf(pdf_bytes)
+    except ErroExtracaoPdf as e:
+        CONTROLE_ADMISSAO.liberar_thread()
+        log.warning(f"Extração falhou no job {job_id}: {e}")
+        remover_job(job_id)
+        return Response(formatar_evento_sse('erro', {'titulo': "Erro ao ler o PDF", 'mensagem': str(e)}), mimetype='text/event-stream')
+    except BaseException:
+        CONTROLE_ADMISSAO.liberar_thread()
+        raise
+    if not CONTROLE_ADMISSAO.adquirir(custo):
+        CONTROLE_ADMISSAO.liberar_thread()
+        return resposta_sobrecarga()
+
+    def gerar():
+        ID_CORRELACAO.set(job_id[:8])
+        try:
+            log.info(f"Iniciando validação progressiva do job {job_id} ('{meta['arquivo']}', modo '{meta['modo']}')...")
+            for evento, dados in processar_validacao_progressiva(pdf_bytes, meta['arquivo'], meta['modo'], meta['emp_fixo']):
+                yield formatar_evento_sse(evento, dados)
+            remover_job(job_id)
+        except ErroExtracaoPdf as e:
+            log.warning(f"Extração falhou no job {job_id}: {e}")
+            remover_job(job_id)
+            yield formatar_evento_sse('erro', {'titulo': "Erro ao ler o PDF", 'mensagem': str(e)})
+        except Exception as e:
+            log.exception(f"Erro inesperado no job {job_id}: {e}")
+            remover_job(job_id)
+            yield formatar_evento_sse('erro', {'titulo': "Erro inesperado no processamento",
+                'mensagem': f"Ocorreu um erro grave durante a análise do arquivo '{meta['arquivo']}'. Detalhes: {e}"})
+
+    resp = Response(stream_with_context(gerar()), mimetype='text/event-stream')
+    # Libera no fechamento da resposta: cobre também o cliente que desconecta antes do primeiro evento
+    def liberar():
+        CONTROLE_ADMISSAO.liberar(custo)
+        CONTROLE_ADMISSAO.liberar_thread()
+    resp.call_on_close(liberar)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no' # Proxies não devem segurar os eventos
+    return resp
+
 @app.route('/compare', methods=['POST'])
+@admissao_controlada
 def compare_files():
     if 'pdf_mes_anterior' not in request.files or 'pdf_mes_atual' not in request.files:
         return manual_render_template('error.html', status_code=400,
@@ -801,9 +2237,8 @@ def compare_files():
                   return manual_render_template('error.html', status_code=400,
                                                 error_title="Modo de Análise Incorreto?", error_message=error_msg)
 
-        print(f"Iniciando comparação modo '{modo_separacao}' entre '{file_ant.filename}' e '{file_atu.filename}'...")
-        texto_ant = extrair_texto_pdf(file_ant.read())
-        texto_atu = extrair_texto_pdf(file_atu.read())
+        log.info(f"Iniciando comparação modo '{modo_separacao}' entre '{file_ant.filename}' e '{file_atu.filename}'...")
+        texto_ant, texto_atu = extrair_textos_pdfs([file_ant.read(), file_atu.read()])
 
         if not texto_ant or not texto_atu:
             err_msg = "Não foi possível extrair texto de um ou ambos os PDFs. "
@@ -811,18 +2246,16 @@ def compare_files():
             elif not texto_ant: err_msg += f"Falha ao ler '{file_ant.filename}'."
             else: err_msg += f"Falha ao ler '{file_atu.filename}'."
             err_msg += " Verifique se não estão corrompidos ou se são imagens."
-            print(f"[ERRO] {err_msg}")
+            log.error(err_msg)
             return manual_render_template('error.html', status_code=500,
                 error_title="Erro ao ler PDF na Comparação", error_message=err_msg)
 
-        print("Textos extraídos. Processando comparação...")
+        log.debug("Textos extraídos. Processando comparação...")
         df_resumo_completo, df_adicionados, df_removidos, df_divergencias, df_parcelas_novas, df_parcelas_removidas = processar_comparativo(
             texto_ant, texto_atu, modo_separacao, emp_fixo_boleto
         )
-        print(f"Comparação concluída. Resumo: {len(df_adicionados)} adicionados, {len(df_removidos)} removidos, {len(df_divergencias)} divergências.")
+        log.info(f"Comparação concluída. Resumo: {len(df_adicionados)} adicionados, {len(df_removidos)} removidos, {len(df_divergencias)} divergências.")
 
-
-        output = io.BytesIO()
         dfs_to_excel = {
             "Resumo": df_resumo_completo,
             "Lotes Adicionados": df_adicionados,
@@ -831,19 +2264,8 @@ def compare_files():
             "Parcelas Novas por Lote": df_parcelas_novas,
             "Parcelas Removidas por Lote": df_parcelas_removidas,
         }
-        print("Gerando arquivo Excel do comparativo...")
-        formatar_excel(output, dfs_to_excel)
-        output.seek(0)
-        print("Arquivo Excel gerado em memória.")
-
-        report_filename = f"comparativo_{modo_separacao}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        report_path = os.path.join(app.config['UPLOAD_FOLDER'], report_filename)
-        try:
-            with open(report_path, 'wb') as f:
-                f.write(output.getvalue())
-            print(f"Relatório comparativo salvo em: {report_path}")
-        except Exception as e_save:
-             print(f"Erro ao salvar o arquivo Excel comparativo em {report_path}: {e_save}")
+        report_filename = nome_relatorio('comparativo', modo_separacao)
+        registrar_relatorio(report_filename, dfs_to_excel)
 
 
         resumo_dict_lotes = {}
@@ -853,7 +2275,7 @@ def compare_files():
              resumo_dict_totais = pd.Series(df_resumo_completo.set_index(' ')['TOTAIS']).map('{:,.2f}'.format).to_dict()
 
 
-        print("Renderizando página de resultados da comparação...")
+        log.debug("Renderizando página de resultados da comparação...")
         return manual_render_template('compare_results.html',
              resumo_lotes_mes_anterior=resumo_dict_lotes.get('Lotes Mês Anterior', 0),
              resumo_lotes_mes_atual=resumo_dict_lotes.get('Lotes Mês Atual', 0),
@@ -876,9 +2298,100 @@ def compare_files():
         )
 
 
+    except ErroExtracaoPdf as e:
+        log.warning(f"Extração falhou na comparação: {e}")
+        return manual_render_template('error.html', status_code=422,
+            error_title="Erro ao ler PDF na Comparação", error_message=str(e))
     except Exception as e:
-        print(f"📕 [ERRO FATAL] Erro inesperado na rota /compare: {e}")
-        traceback.print_exc()
+        log.exception(f"Erro inesperado na rota /compare: {e}")
+        error_details = f"{type(e).__name__}: {e}"
+        return manual_render_template('error.html', status_code=500,
+            error_title="Erro inesperado na comparação",
+            error_message=f"Ocorreu um erro grave durante a comparação dos arquivos. Detalhes: {error_details}")
+
+def _checar_envio_serie(arquivos: list, modo_separacao: str):
+    """Confere quantidade, tipo e nome dos arquivos da série x modo. Retorna (emp_fixo, resposta de erro ou None)."""
+    if len(arquivos) < 2:
+        return None, manual_render_template('error.html', status_code=400,
+            error_title="Arquivos faltando",
+            error_message="Selecione pelo menos dois arquivos PDF (um por mês) para a comparação em série.")
+    if len(arquivos) > COMPARATIVO_MAX_MESES:
+        return None, manual_render_template('error.html', status_code=400,
+            error_title="Arquivos demais",
+            error_message=f"A comparação em série aceita no máximo {COMPARATIVO_MAX_MESES} arquivos; foram enviados {len(arquivos)}.")
+    if any(not f.filename.lower().endswith('.pdf') for f in arquivos):
+        return None, manual_render_template('error.html', status_code=400,
+            error_title="Tipo de Arquivo Inválido",
+            error_message="Por favor, envie apenas arquivos no formato PDF para comparação.")
+
+    emps = [detectar_emp_por_nome_arquivo(f.filename) for f in arquivos]
+    if modo_separacao == 'boleto':
+        if not all(emps):
+            sem_emp = ", ".join(f"'{f.filename}'" for f, emp in zip(arquivos, emps) if not emp)
+            return None, manual_render_template('error.html', status_code=400,
+                error_title="Empreendimento não identificado (Modo Boleto)",
+                error_message=f"Para o modo 'Boleto', o nome de todos os arquivos PDF precisa terminar com um código de empreendimento válido. Verifique: {sem_emp}.")
+        if len(set(emps)) > 1:
+            return None, manual_render_template('error.html', status_code=400,
+                error_title="Empreendimentos diferentes (Modo Boleto)",
+                error_message=f"Os arquivos devem ser do mesmo empreendimento para comparação no modo Boleto (Detectado: {', '.join(sorted(set(emps)))}).")
+        return emps[0], None
+
+    if modo_separacao in ['debito_credito', 'ccb_realiza'] and any(emps):
+        error_msg = (f"Um dos arquivos parece ser do tipo 'Boleto' (termina com código), mas o modo '{modo_separacao.replace('_','/').upper()}' foi selecionado. "
+                     "Use o modo 'Boleto' para esses arquivos ou renomeie-os se a detecção estiver incorreta.")
+        return None, manual_render_template('error.html', status_code=400,
+                                            error_title="Modo de Análise Incorreto?", error_message=error_msg)
+    return None, None
+
+@app.route('/compare/serie', methods=['POST'])
+@admissao_controlada
+def compare_serie():
+    arquivos = [f for f in request.files.getlist('pdfs_meses') if f and f.filename]
+    modo_separacao = request.form.get('modo_separacao_serie', 'boleto')
+    emp_fixo_boleto, erro = _checar_envio_serie(arquivos, modo_separacao)
+    if erro:
+        return erro
+
+    try:
+        # A ordem do FileList depende do navegador e do sistema: a sequência dos meses é a do nome
+        # do arquivo, em ordem natural (a mesma que a página mostra antes do envio)
+        arquivos.sort(key=lambda f: chave_nome_natural(f.filename))
+        rotulos = rotulos_meses([f.filename for f in arquivos])
+        log.info(f"Iniciando comparação em série modo '{modo_separacao}' de {len(arquivos)} arquivos: {', '.join(rotulos)}...")
+        textos = extrair_textos_pdfs([f.read() for f in arquivos])
+
+        sem_texto = [f"'{f.filename}'" for f, texto in zip(arquivos, textos) if not texto]
+        if sem_texto:
+            err_msg = (f"Não foi possível extrair texto de {', '.join(sem_texto)}. "
+                       "Verifique se não estão corrompidos ou se são imagens.")
+            log.error(err_msg)
+            return manual_render_template('error.html', status_code=500,
+                error_title="Erro ao ler PDF na Comparação", error_message=err_msg)
+
+        planilhas, resumo_transicoes = processar_comparativo_serie(textos, rotulos, modo_separacao, emp_fixo_boleto)
+        df_alterados = planilhas["Valores Alterados"]
+        log.info(f"Comparação em série concluída: {len(planilhas['Matriz de Valores'])} parcelas na matriz, {len(df_alterados)} com valor alterado.")
+
+        report_filename = nome_relatorio('comparativo_serie', modo_separacao)
+        registrar_relatorio(report_filename, planilhas)
+
+        return manual_render_template('compare_series_results.html',
+            meses=html.escape(" → ".join(rotulos)),
+            total_meses=len(rotulos),
+            total_parcelas_alteradas=len(df_alterados),
+            transicoes_json=json.dumps({'transicoes': resumo_transicoes}).replace('<', '\\u003c'), # Rótulos vêm dos nomes dos arquivos
+            alterados_json=df_alterados.to_json(orient='split', index=False) if not df_alterados.empty else 'null',
+            download_url=url_for('download_file', filename=report_filename),
+            modo_usado=modo_separacao.replace('_', '/').upper()
+        )
+
+    except ErroExtracaoPdf as e:
+        log.warning(f"Extração falhou na comparação em série: {e}")
+        return manual_render_template('error.html', status_code=422,
+            error_title="Erro ao ler PDF na Comparação", error_message=str(e))
+    except Exception as e:
+        log.exception(f"Erro inesperado na rota /compare/serie: {e}")
         error_details = f"{type(e).__name__}: {e}"
         return manual_render_template('error.html', status_code=500,
             error_title="Erro inesperado na comparação",
@@ -917,30 +2430,66 @@ def configuracoes_sair():
     session.pop('config_auth', None)
     return redirect('/')
 
+def _config_do_payload(data: dict) -> dict:
+    """Converte o JSON enviado pela tela de configurações no formato do config.json."""
+    emp_map = {k: {"Melhoramentos": float(v["Melhoramentos"]), "Fundo de Transporte": float(v["Fundo de Transporte"])} for k, v in data.get('EMP_MAP', {}).items()}
+    base_fixos = {}
+    for k, v in data.get('BASE_FIXOS', {}).items():
+        vals = [float(x) for x in v if x is not None and float(x) > 0] if isinstance(v, list) else ([float(v)] if v else [])
+        base_fixos[k] = vals
+    return {"EMP_MAP": emp_map, "BASE_FIXOS": base_fixos}
+
+@app.route('/configuracoes/previa', methods=['POST'])
+def configuracoes_previa():
+    """Mostra quantas divergências a configuração proposta geraria nas análises recentes, sem salvar."""
+    if not session.get('config_auth'):
+        return jsonify({'ok': False, 'erro': 'Não autorizado.'}), 401
+    try:
+        cfg_proposta = _config_do_payload(request.get_json(force=True))
+        analises = carregar_analises()
+        atuais = {r['id']: r for r in revalidar_analises(carregar_config(), analises, gerar_relatorios=False)}
+        previa = []
+        for r in revalidar_analises(cfg_proposta, analises, gerar_relatorios=False):
+            r['divergencias_antes'] = atuais[r['id']]['divergencias_depois']
+            previa.append(r)
+        return jsonify({'ok': True, 'analises': previa})
+    except Exception as e:
+        log.error(f"[CONFIG] ERRO na prévia: {e}")
+        return jsonify({'ok': False, 'erro': str(e)}), 500
+
+@app.route('/configuracoes/revalidar', methods=['POST'])
+def configuracoes_revalidar():
+    """Reaplica a configuração atual às análises recentes e gera novos relatórios."""
+    if not session.get('config_auth'):
+        return jsonify({'ok': False, 'erro': 'Não autorizado.'}), 401
+    try:
+        inicio = time.perf_counter()
+        resultados = revalidar_analises(carregar_config())
+        log.info(f"[ANALISES] {len(resultados)} análise(s) revalidada(s) em {time.perf_counter() - inicio:.2f}s.")
+        return jsonify({'ok': True, 'analises': resultados})
+    except Exception as e:
+        log.exception(f"[ANALISES] ERRO ao revalidar: {e}")
+        return jsonify({'ok': False, 'erro': str(e)}), 500
+
 @app.route('/configuracoes/salvar', methods=['POST'])
 def configuracoes_salvar():
     if not session.get('config_auth'):
         return jsonify({'ok': False, 'erro': 'Não autorizado.'}), 401
     try:
-        data = request.get_json(force=True)
-        emp_map = {k: {"Melhoramentos": float(v["Melhoramentos"]), "Fundo de Transporte": float(v["Fundo de Transporte"])} for k, v in data.get('EMP_MAP', {}).items()}
-        base_fixos = {}
-        for k, v in data.get('BASE_FIXOS', {}).items():
-            vals = [float(x) for x in v if x is not None and float(x) > 0] if isinstance(v, list) else ([float(v)] if v else [])
-            base_fixos[k] = vals
-        nova_config = {"EMP_MAP": emp_map, "BASE_FIXOS": base_fixos}
+        nova_config = _config_do_payload(request.get_json(force=True))
+        emp_map = nova_config['EMP_MAP']
         alteracoes = salvar_config(nova_config)
         # Verificação pós-gravação
         cfg_lido = carregar_config()
         ok = cfg_lido.get('EMP_MAP') == emp_map
-        print(f"[CONFIG] Verificação pós-save: EMP_MAP correto={ok}, arquivo existe={os.path.exists(CONFIG_PATH)}")
+        log.info(f"[CONFIG] Verificação pós-save: EMP_MAP correto={ok}, arquivo existe={os.path.exists(CONFIG_PATH)}")
         # Commit automático no GitHub (torna a mudança permanente)
         github_ok, github_msg = False, 'GitHub não configurado.'
         if github_configurado():
             github_ok, github_msg = commitar_config_github(nova_config, alteracoes)
         return jsonify({'ok': True, 'github_ok': github_ok, 'github_msg': github_msg})
     except Exception as e:
-        print(f"[CONFIG] ERRO ao salvar: {e}")
+        log.error(f"[CONFIG] ERRO ao salvar: {e}")
         return jsonify({'ok': False, 'erro': str(e)}), 500
 
 @app.route('/configuracoes/verificar')
@@ -955,32 +2504,56 @@ def configuracoes_verificar():
         'config': cfg,
     })
 
+@app.route('/status')
+def status():
+    return jsonify({'admissao': CONTROLE_ADMISSAO.estatisticas(), 'extracao': EXTRATOR_PDF.estatisticas()})
+
 @app.route('/download/<filename>')
 def download_file(filename):
-     safe_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+     safe_path = os.path.join(RELATORIOS_FOLDER, filename)
      normalized_safe_path = os.path.normpath(safe_path)
-     normalized_upload_folder = os.path.normpath(app.config['UPLOAD_FOLDER'])
+     normalized_reports_folder = os.path.normpath(RELATORIOS_FOLDER)
 
      # Adiciona 'os.sep' para garantir que não pegue pastas com nome parecido
-     if not normalized_safe_path.startswith(normalized_upload_folder + os.sep) and normalized_safe_path != normalized_upload_folder :
-         print(f" Tentativa de acesso a caminho inválido: {filename} (Normalizado: {normalized_safe_path} vs Base: {normalized_upload_folder})")
+     if not normalized_safe_path.startswith(normalized_reports_folder + os.sep) or not filename.endswith('.xlsx'):
+         log.warning(f"Tentativa de acesso a caminho inválido: {filename} (Normalizado: {normalized_safe_path} vs Base: {normalized_reports_folder})")
          return "Acesso negado.", 403
 
-     if not os.path.exists(safe_path):
-          print(f" Arquivo não encontrado para download: {filename}")
+     # O primeiro download monta a planilha com openpyxl: passa pela admissão como as rotas pesadas
+     custo = custo_montagem_relatorio(filename)
+     if custo is not None and not CONTROLE_ADMISSAO.ocupar_thread():
+         return resposta_sobrecarga()
+     try:
+         if custo is not None and not CONTROLE_ADMISSAO.adquirir(custo):
+             return resposta_sobrecarga()
+         try:
+             report_path = montar_relatorio(filename)
+         except Exception as e:
+             log.exception(f"Erro ao montar o relatório {filename}: {e}")
+             return manual_render_template('error.html', status_code=500,
+                 error_title="Erro ao gerar o relatório",
+                 error_message=f"Não foi possível montar a planilha. Detalhes: {type(e).__name__}: {e}")
+         finally:
+             if custo is not None:
+                 CONTROLE_ADMISSAO.liberar(custo)
+     finally:
+         if custo is not None:
+             CONTROLE_ADMISSAO.liberar_thread()
+     if report_path is None:
+          log.warning(f"Arquivo não encontrado para download: {filename}")
           return "Arquivo não encontrado.", 404
 
-     print(f"Enviando arquivo para download: {filename}")
-     return send_file(safe_path, as_attachment=True)
+     log.info(f"Enviando arquivo para download: {filename}")
+     return send_file(report_path, as_attachment=True)
 
 
 if __name__ == '__main__':
-    print("Iniciando servidor Flask local...")
+    log.info("Iniciando servidor Flask local...")
     port = int(os.environ.get('PORT', 8080))
     # Verifica variável de ambiente FLASK_DEBUG para modo debug
     debug_mode = os.environ.get('FLASK_DEBUG') == '1'
     # Usa host='0.0.0.0' para ser acessível na rede local ou pelo Render
-    print(f"Executando em http://0.0.0.0:{port} (debug={debug_mode})")
+    log.info(f"Executando em http://0.0.0.0:{port} (debug={debug_mode})")
     # threaded=True pode ajudar a evitar timeouts em requisições longas localmente
     app.run(debug=debug_mode, host='0.0.0.0', port=port, threaded=True)
 
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Teste diferencial do parser sobre um corpus de extratos reais (anonimizados).
+
+Extrai cada PDF da pasta uma vez e roda o motor de referência (app.parsear_lotes) e cada motor
+alternativo sobre o mesmo texto, validando com a mesma configuração. As saídas df_todas, df_cov
+e df_div são comparadas linha a linha e o tempo de cada motor é reportado por arquivo.
+
+Um motor é qualquer função com a assinatura de parsear_lotes(texto_pdf, modo, emp_fixo_boleto),
+informada como "modulo:funcao". Um motor só pode virar o padrão se a saída for idêntica em
+todos os arquivos: o script termina com código 1 se houver qualquer diferença.
+
+Uso:
+    python comparar_motores.py corpus/ --motor parser_rapido:parsear_lotes
+    python comparar_motores.py corpus/ --motor parser_rapido:parsear_lotes --modo ccb_realiza --repeticoes 5
+
+O modo de cada arquivo segue a regra das rotas: nome terminado em código de empreendimento é
+Boleto; os demais usam --modo (padrão: debito_credito).
+"""
+import os
+import sys
+import time
+import math
+import argparse
+import difflib
+import importlib
+
+# Antes de importar o app: extração no próprio processo e log só de avisos
+os.environ.setdefault('EXTRACAO_ISOLADA', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import pandas as pd
+import app
+
+SAIDAS = ('df_todas', 'df_cov', 'df_div')
+MAX_DIFERENCAS_LISTADAS = 5 # Por DataFrame, para o relatório não virar um despejo
+
+def carregar_motor(especificacao: str):
+    """Importa 'modulo:funcao' e devolve a função."""
+    modulo, _, funcao = especificacao.partition(':')
+    if not funcao:
+        raise SystemExit(f"Motor inválido '{especificacao}': use o formato modulo:funcao.")
+    return getattr(importlib.import_module(modulo), funcao)
+
+def modo_do_arquivo(nome: str, modo_padrao: str):
+    emp = app.detectar_emp_por_nome_arquivo(nome)
+    return ('boleto', emp) if emp else (modo_padrao, None)
+
+def executar(motor, texto: str, modo: str, emp_fixo: str, cfg: dict, repeticoes: int):
+    """Roda parse + validação `repeticoes` vezes. Retorna (saídas, melhor tempo em segundos)."""
+    melhor = math.inf
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        saidas = app.validar_lotes(motor(texto, modo, emp_fixo), modo, cfg)
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return dict(zip(SAIDAS, saidas)), melhor
+
+def _chave_linha(linha) -> tuple:
+    # NaN != NaN: vira None. O tipo entra na chave, então 1 e 1.0 ou "1" e 1 contam como diferença
+    return tuple(None if pd.isna(valor) else (type(valor).__name__, valor) for valor in linha)
+
+def diferencas(ref: pd.DataFrame, novo: pd.DataFrame) -> list:
+    """Descrição das diferenças entre dois DataFrames, linha a linha (lista vazia se idênticos).
+
+    As linhas são alinhadas com difflib, então uma linha a mais ou a menos aparece como uma
+    diferença só, e não desloca a comparação de todas as seguintes.
+    """
+    if list(ref.columns) != list(novo.columns):
+        return [f"colunas diferentes: {list(ref.columns)} x {list(novo.columns)}"]
+    linhas_ref, linhas_novo = list(ref.itertuples(index=False, name=None)), list(novo.itertuples(index=False, name=None))
+    comparador = difflib.SequenceMatcher(None, [_chave_linha(l) for l in linhas_ref], [_chave_linha(l) for l in linhas_novo], autojunk=False)
+    achadas = []
+    for operacao, i1, i2, j1, j2 in comparador.get_opcodes():
+        if operacao == 'equal':
+            continue
+        pares = list(zip(range(i1, i2), range(j1, j2))) if operacao == 'replace' else []
+        for i, j in pares:
+            achadas.append(f"linha {i} (motor: {j}): {linhas_ref[i]} x {linhas_novo[j]}")
+        for i in range(i1 + len(pares), i2):
+            achadas.append(f"linha {i} só na referência: {linhas_ref[i]}")
+        for j in range(j1 + len(pares), j2):
+            achadas.append(f"linha {j} só no motor: {linhas_novo[j]}")
+    return achadas
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara motores do parser sobre um corpus de extratos em PDF.")
+    parser.add_argument('pasta', help="pasta com os PDFs anonimizados")
+    parser.add_argument('--motor', action='append', default=[], help="motor alternativo (modulo:funcao); pode repetir")
+    parser.add_argument('--referencia', default='app:parsear_lotes', help="motor de referência (padrão: app:parsear_lotes)")
+    parser.add_argument('--modo', default='debito_credito', choices=['debito_credito', 'ccb_realiza'], help="modo dos arquivos que não são Boleto")
+    parser.add_argument('--repeticoes', type=int, default=3, help="execuções por motor e arquivo; vale o melhor tempo")
+    args = parser.parse_args()
+
+    arquivos = sorted(n for n in os.listdir(args.pasta) if n.lower().endswith('.pdf'))
+    if not arquivos:
+        raise SystemExit(f"Nenhum PDF encontrado em '{args.pasta}'.")
+    referencia = carregar_motor(args.referencia)
+    motores = {especificacao: carregar_motor(especificacao) for especificacao in args.motor}
+    cfg = app.carregar_config() # A mesma configuração para todos os motores
+
+    aceleracoes = {especificacao: [] for especificacao in motores}
+    divergentes = {especificacao: 0 for especificacao in motores}
+    for nome in arquivos:
+        modo, emp_fixo = modo_do_arquivo(nome, args.modo)
+        with open(os.path.join(args.pasta, nome), 'rb') as f:
+            texto = app.extrair_texto_pdf(f.read())
+        if not texto:
+            print(f"{nome}: sem texto extraído, ignorado.")
+            continue
+
+        saidas_ref, tempo_ref = executar(referencia, texto, modo, emp_fixo, cfg, args.repeticoes)
+        print(f"\n{nome} (modo {modo}{', ' + emp_fixo if emp_fixo else ''}): "
+              f"{len(saidas_ref['df_cov'])} lotes, referência em {tempo_ref * 1000:.1f} ms")
+        for especificacao, motor in motores.items():
+            try:
+                saidas, tempo = executar(motor, texto, modo, emp_fixo, cfg, args.repeticoes)
+            except Exception as e:
+                divergentes[especificacao] += 1
+                print(f"  {especificacao}: ERRO {type(e).__name__}: {e}")
+                continue
+            aceleracao = tempo_ref / tempo if tempo else math.inf
+            aceleracoes[especificacao].append(aceleracao)
+            achadas = {saida: diferencas(saidas_ref[saida], saidas[saida]) for saida in SAIDAS}
+            total = sum(len(a) for a in achadas.values())
+            situacao = "IDÊNTICO" if not total else f"{total} DIFERENÇA(S)"
+            print(f"  {especificacao}: {tempo * 1000:.1f} ms, {aceleracao:.2f}x, {situacao}")
+            if total:
+                divergentes[especificacao] += 1
+                for saida, lista in achadas.items():
+                    for descricao in lista[:MAX_DIFERENCAS_LISTADAS]:
+                        print(f"    {saida}: {descricao}")
+                    if len(lista) > MAX_DIFERENCAS_LISTADAS:
+                        print(f"    {saida}: ... mais {len(lista) - MAX_DIFERENCAS_LISTADAS}")
+
+    if not motores:
+        print("\nNenhum motor alternativo informado (--motor modulo:funcao); só a referência foi medida.")
+        return 0
+    print("\nResumo:")
+    for especificacao in motores:
+        valores = aceleracoes[especificacao]
+        media = math.exp(sum(map(math.log, valores)) / len(valores)) if valores else float('nan')
+        situacao = "pode virar o padrão" if not divergentes[especificacao] else f"diverge em {divergentes[especificacao]} arquivo(s)"
+        print(f"  {especificacao}: aceleração média (geométrica) {media:.2f}x, {situacao}")
+    return 1 if any(divergentes.values()) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Remoção de cabeçalhos e rodapés repetidos: rótulos de parcela na borda da página não podem sair."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('EXTRACAO_ISOLADA', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import app
+
+PAGINAS = 6
+
+def _pagina(n: int, fim: list) -> str:
+    """Página com cabeçalho, um lote e as linhas `fim` no rodapé (formato "Rótulo \\n Valor")."""
+    lote = f"04.A{n}.{n:03d}"
+    return "\n".join([
+        f"Remessa para Conferência                                        Página {n + 1}",
+        "Banco XYZ",
+        lote,
+        f"FULANO DE TAL {chr(65 + n)}",
+        "Lançamentos",
+        "Melhoramentos  250,42",
+        "Fundo de Transporte  9,00",
+        *fim,
+        f"Emitido pelo sistema de cobrança - folha {n + 1}",
+    ])
+
+def _parcelas_por_lote(paginas: list) -> dict:
+    entrada = [(i, len(paginas), texto) for i, texto in enumerate(paginas)]
+    texto = "".join(t + "\n" for _, _, t in app.remover_cabecalhos_repetidos(iter(entrada)))
+    return {r["Lote"]: dict(r["Itens"]) for r in app.parsear_lotes(texto, 'debito_credito')}
+
+def test_total_a_pagar_em_linha_propria_no_rodape_e_mantido():
+    paginas = [_pagina(n, ["TOTAL A PAGAR", f"1.{700 + n},42"]) for n in range(PAGINAS)]
+    for lote, parcelas in _parcelas_por_lote(paginas).items():
+        assert parcelas.get("TOTAL A PAGAR") is not None, lote
+
+def test_rotulo_desconhecido_seguido_do_valor_e_mantido():
+    paginas = [_pagina(n, ["Taxa Avulsa", "12,34"]) for n in range(PAGINAS)]
+    for lote, parcelas in _parcelas_por_lote(paginas).items():
+        assert parcelas.get("Taxa Avulsa") == 12.34, lote
+
+def test_rodape_repetido_continua_sendo_removido():
+    paginas = [_pagina(n, ["TOTAL A PAGAR", "1.709,42"]) for n in range(PAGINAS)]
+    entrada = [(i, PAGINAS, texto) for i, texto in enumerate(paginas)]
+    saida = "".join(t for _, _, t in app.remover_cabecalhos_repetidos(iter(entrada)))
+    assert "Emitido pelo sistema de cobrança" not in saida
+    assert "Banco XYZ" not in saida